@@ -47,6 +47,8 @@ class NestedCmd(Basic):
             mem=1024 ** 3 * 1,
             metadata=args['metadata'],
             out_prefix=args['prefix'],
+            # 可选, 中间文件, 多个用逗号隔开, 可用通配符; 所有下游步骤都成功后被删除, 设置temp_action='gzip'时改为压缩
+            # temp_outputs=args['prefix'] + '.fancyvj.wt.txt',
         )
         # 4. update workflow
         self.workflow.update(commands)
@@ -69,7 +71,10 @@ class NestedCmd(Basic):
                 cpu=2,
                 mem=1024 ** 3 * 1,
                 sample=sample,
-                out=args['out']
+                out=args['out'],
+                # 可选, 声明输入输出文件后, 输出比输入新且cmd和输入未变化时, 该步骤不会被重新运行
+                inputs=args['data'],
+                outputs=args['out'],
             )
         self.workflow.update(commands)
         return commands
@@ -0,0 +1,195 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import sys
+import argparse
+from nestpipe.state_db import StateDB, main_step
+
+
+def status(args):
+    db_file = os.path.join(args.outdir, 'cmd_state.db')
+    if os.path.exists(db_file):
+        db = StateDB(db_file, readonly=True)
+        summary = db.summary(step=args.step)
+        tasks = db.query(step=args.step, state=args.state, name=args.name, limit=args.limit) \
+            if (args.step or args.state or args.name) else []
+        db.close()
+    else:
+        # 没有使用sqlite状态存储时, 读取状态表cmd_state.txt并回放其后的日志, 运行中的流程也能看到最新状态
+        from nestpipe.nestpipe import read_state_table
+        records = read_state_table(args.outdir)
+        if not records:
+            exit('We found neither cmd_state.db nor cmd_state.txt in {}!'.format(args.outdir))
+        counts = dict()
+        tasks = list()
+        for name, record in records.items():
+            state = record['state']
+            if args.step and main_step(name) != args.step:
+                continue
+            counts.setdefault((main_step(name), state), 0)
+            counts[(main_step(name), state)] += 1
+            if (args.step or args.state or args.name) \
+                    and (not args.state or state == args.state) and (not args.name or name == args.name):
+                tasks.append((name, state, record['used_time'], record['mem'], record['cpu'], record['pid'], '',
+                              record.get('depend', ''), record.get('cmd', '')))
+        summary = sorted((k[0], k[1], v) for k, v in counts.items())
+        if args.limit:
+            tasks = tasks[:args.limit]
+
+    print('step\tstate\tnumber')
+    for row in summary:
+        print('\t'.join(str(x) for x in row))
+    if tasks:
+        print()
+        print('\t'.join(['name', 'state', 'used_time', 'mem', 'cpu', 'pid', 'attempts', 'depend', 'cmd']))
+        for row in tasks:
+            print('\t'.join(str(x) for x in row))
+
+
+def graph(args):
+    from nestpipe.nestpipe import read_state_table, draw_state_graph, pgv
+    if pgv is None:
+        exit('pygraphviz is needed to draw state graph!')
+    state = read_state_table(args.outdir)
+    if not state:
+        exit('We found no cmd_state.txt in {}!'.format(args.outdir))
+    for name, record in state.items():
+        record.setdefault('depend', '')
+        record.setdefault('cmd', '')
+    if args.out:
+        img_file = args.out
+    elif args.step:
+        img_file = os.path.join(args.outdir, 'state.{}.svg'.format(args.step))
+    else:
+        img_file = os.path.join(args.outdir, 'state.svg')
+    draw_state_graph(state, img_file, step=args.step, collapse=args.collapse)
+    print('State graph was written to {}'.format(img_file))
+
+
+def tune(args):
+    import configparser
+    from nestpipe.resource_tuning import ResourceTuner
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str
+    config.read(args.pipeline, encoding='utf-8')
+    tuner = ResourceTuner(args.past, quantile=args.quantile, headroom=args.headroom, min_samples=args.min_samples)
+    tuned = tuner.tune(config, apply=args.apply)
+    print('\t'.join(['name', 'cpu', 'mem', 'time', 'samples']))
+    for name, suggestion in tuned.items():
+        print('\t'.join([name] + [str(suggestion[x]) for x in ['cpu', 'mem', 'time', 'samples']]))
+    out = args.out or args.pipeline
+    with open(out, 'w') as f:
+        config.write(f)
+    print('{} of {} tasks were tuned, written to {}'.format(len(tuned), len(config.sections()) - 1, out))
+
+
+def logs(args):
+    import glob
+    from collections import deque
+    from nestpipe.log_archive import task_log
+    log_dir = os.path.join(args.outdir, 'logs')
+    streams = [args.stream] if args.stream else None
+    result = task_log(log_dir, args.name, attempt=args.attempt, streams=streams, tail=args.tail)
+    if not result:
+        # 没有开启日志归档时, 读取logs中最近一次运行的日志文件
+        for stream in streams or ['stdout', 'stderr']:
+            files = glob.glob(os.path.join(log_dir, '{}.*.{}.txt'.format(glob.escape(args.name), stream)))
+            if not files:
+                continue
+            log_file = max(files, key=os.path.getmtime)
+            with open(log_file, errors='replace') as f:
+                lines = deque(f, maxlen=args.tail) if args.tail else f.readlines()
+            result.append((dict(stream=stream, data_file=log_file), [x.rstrip('\n') for x in lines]))
+    if not result:
+        exit('We found no log of {} in {}!'.format(args.name, log_dir))
+    for record, lines in result:
+        if 'attempt' in record:
+            print('==> {} attempt {} {} (pid {}) <=='.format(args.name, record['attempt'], record['stream'], record['pid']))
+        else:
+            print('==> {} <=='.format(record['data_file']))
+        for line in lines:
+            print(line)
+
+
+def report(args):
+    from nestpipe.timeline import report as write_timeline
+    event_file = os.path.join(args.outdir, 'events.jsonl')
+    if not os.path.exists(event_file):
+        exit('We found no events.jsonl in {}, was event_log disabled?'.format(args.outdir))
+    out = write_timeline(args.outdir, out_file=args.out, run=args.run)
+    print('Timeline report was written to {}'.format(out))
+
+
+def worker(args):
+    from nestpipe.worker import run_worker
+    run_worker(args)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='nestpipe')
+    subparsers = parser.add_subparsers(dest='command')
+    status_parser = subparsers.add_parser('status', help="query task state of a running or finished pipeline")
+    status_parser.add_argument('-outdir', default='.', help="output directory of the pipeline")
+    status_parser.add_argument('-step', help="main step name, such as 3.Align")
+    status_parser.add_argument('-state', help="task state, such as failed/running/success")
+    status_parser.add_argument('-name', help="task name")
+    status_parser.add_argument('-limit', type=int, default=None, help="max number of tasks to show")
+    status_parser.set_defaults(func=status)
+    graph_parser = subparsers.add_parser('graph', help="draw state graph of the whole pipeline or one main step")
+    graph_parser.add_argument('-outdir', default='.', help="output directory of the pipeline")
+    graph_parser.add_argument('-step', help="only draw tasks of this main step, such as 3.Align")
+    graph_parser.add_argument('-out', help="output image file, default to state.svg or state.<step>.svg in outdir")
+    graph_parser.add_argument('--collapse', action='store_true', default=False,
+                              help="if set, tasks of the same main step are merged into one node")
+    graph_parser.set_defaults(func=graph)
+    tune_parser = subparsers.add_parser('tune', help="estimate cpu/mem requests of pipeline.ini from past runs")
+    tune_parser.add_argument('-pipeline', required=True, help="pipeline.ini to tune")
+    tune_parser.add_argument('-past', required=True, nargs='+', help="output directories of past runs")
+    tune_parser.add_argument('-out', help="output pipeline.ini, default to overwrite the input one")
+    tune_parser.add_argument('-quantile', type=float, default=0.95, help="quantile of measured usage, default 0.95")
+    tune_parser.add_argument('-headroom', type=float, default=1.2, help="headroom factor over the quantile, default 1.2")
+    tune_parser.add_argument('-min_samples', type=int, default=3,
+                             help="min number of past tasks of the same step and tool, default 3")
+    tune_parser.add_argument('--apply', action='store_true', default=False,
+                             help="if set, cpu/mem are replaced (old values kept as orig_cpu/orig_mem), "
+                                  "otherwise suggest_cpu/suggest_mem/suggest_time are added")
+    tune_parser.set_defaults(func=tune)
+    logs_parser = subparsers.add_parser('logs', help="show stdout/stderr of a task, read from the log archive if any")
+    logs_parser.add_argument('name', help="task name")
+    logs_parser.add_argument('-outdir', default='.', help="output directory of the pipeline")
+    logs_parser.add_argument('-tail', '--tail', type=int, default=None, help="only show the last N lines")
+    logs_parser.add_argument('-attempt', type=int, default=None, help="which attempt to show, default the last one")
+    logs_parser.add_argument('-stream', choices=['stdout', 'stderr', 'resource'], default=None,
+                             help="only show this kind of log, default all")
+    logs_parser.set_defaults(func=logs)
+    report_parser = subparsers.add_parser('report', help="draw gantt charts and concurrency of a run from events.jsonl")
+    report_parser.add_argument('-outdir', default='.', help="output directory of the pipeline")
+    report_parser.add_argument('-out', help="output html file, default to timeline.html in outdir")
+    report_parser.add_argument('-run', type=int, default=-1,
+                               help="which run recorded in events.jsonl to show, such as 0 for the first, default the last")
+    report_parser.set_defaults(func=report)
+    worker_parser = subparsers.add_parser('worker', help="start a worker agent which runs tasks sent by the scheduler")
+    worker_parser.add_argument('-host', default='127.0.0.1',
+                               help="address to listen on, use 0.0.0.0 to accept schedulers on other nodes")
+    worker_parser.add_argument('-token', default=None,
+                               help="shared token which must match worker_token in [mode] of pipeline.ini, "
+                                    "default from environment variable NESTPIPE_WORKER_TOKEN")
+    worker_parser.add_argument('-port', default=7000, type=int, help="port to listen on")
+    worker_parser.add_argument('-cpu', type=float, default=None, help="cpu number offered to the scheduler, default all")
+    worker_parser.add_argument('-mem', type=float, default=None,
+                               help="memory in bytes offered to the scheduler, default available memory")
+    worker_parser.add_argument('-io_budget', type=float, default=None,
+                               help="sum of io weights of tasks running at the same time, default no limit")
+    worker_parser.add_argument('-log', default=os.path.join(os.getcwd(), 'worker.log'), help="log file of the worker")
+    worker_parser.add_argument('--pin_cpu', action='store_true', default=False,
+                               help="if set, each task is pinned to its own cpu cores according to its cpu request")
+    worker_parser.set_defaults(func=worker)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import glob
+import math
+import threading
+
+# 任务绑定cpu后, 常见的多线程库按这些环境变量确定线程数
+THREAD_ENV = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def parse_cpu_list(text):
+    """解析/sys中的cpulist格式, 如 '0-3,8-11' """
+    cpus = list()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def read_numa_nodes(sys_dir='/sys/devices/system/node'):
+    """
+    从/sys读取NUMA拓扑, 只保留当前进程允许使用的cpu
+    :return: dict, {numa节点编号: [cpu编号]}, 读取不到拓扑时所有cpu视为同一个节点
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        allowed = os.sched_getaffinity(0)
+    else:
+        allowed = set(range(os.cpu_count() or 1))
+    nodes = dict()
+    for each in glob.glob(os.path.join(sys_dir, 'node[0-9]*', 'cpulist')):
+        node = int(os.path.basename(os.path.dirname(each))[4:])
+        with open(each) as f:
+            cpus = [x for x in parse_cpu_list(f.read()) if x in allowed]
+        if cpus:
+            nodes[node] = cpus
+    if not nodes:
+        nodes[0] = sorted(allowed)
+    return nodes
+
+
+class CoreMap(object):
+    """
+    本机cpu的分配表, 给每个任务分配互不重叠的cpu: 优先放进剩余cpu最少但足够的一个NUMA节点,
+    一个节点放不下时才跨节点分配; 剩余cpu不足时不分配, 任务不绑定cpu运行
+    """
+    def __init__(self, nodes=None):
+        self.nodes = nodes if nodes is not None else read_numa_nodes()
+        self.free = {k: list(v) for k, v in self.nodes.items()}
+        self.allocated = dict()
+        self.lock = threading.Lock()
+
+    @property
+    def total(self):
+        return sum(len(x) for x in self.nodes.values())
+
+    def allocate(self, name, cpu):
+        """
+        :param cpu: 任务申报的cpu数目, 向上取整; 为0时不绑定
+        :return: 分配的cpu编号列表, 不分配时为None
+        """
+        number = int(math.ceil(float(cpu)))
+        if number <= 0:
+            return None
+        with self.lock:
+            if name in self.allocated or sum(len(x) for x in self.free.values()) < number:
+                return None
+            fits = [x for x in self.free if len(self.free[x]) >= number]
+            cores = list()
+            if fits:
+                node = min(fits, key=lambda x: (len(self.free[x]), x))
+                cores, self.free[node] = self.free[node][:number], self.free[node][number:]
+            else:
+                for node in sorted(self.free, key=lambda x: -len(self.free[x])):
+                    taken = self.free[node][:number - len(cores)]
+                    self.free[node] = self.free[node][len(taken):]
+                    cores.extend(taken)
+                    if len(cores) == number:
+                        break
+            self.allocated[name] = cores
+            return cores
+
+    def release(self, name):
+        with self.lock:
+            for core in self.allocated.pop(name, []):
+                for node, cpus in self.nodes.items():
+                    if core in cpus:
+                        self.free[node].append(core)
+                        self.free[node].sort()
+                        break
@@ -0,0 +1,257 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+# 任务进程的启动方式:
+# 1. 命令中没有shell特殊字符时直接exec, 不再经过/bin/sh -c;
+# 2. 每个任务在新的会话中启动, 其pid即进程组号, 超时、重试和退出时可以结束整个进程组;
+# 3. 可选的forkserver: 由一个小进程负责创建任务进程, 创建进程的开销与调度进程的内存大小无关.
+# 本模块不依赖nestpipe的其他模块, forkserver以 'python launcher.py' 的方式单独运行
+import os
+import sys
+import json
+import shlex
+import shutil
+import signal
+import threading
+import contextlib
+import subprocess
+from concurrent.futures import Future
+
+try:
+    import psutil
+except ImportError:
+    # forkserver本身不需要psutil
+    psutil = None
+
+# 出现这些字符时必须交给shell解释
+SHELL_CHARS = set('|&;<>()$`\\*?[]#~{}!\n')
+
+
+def command_args(cmd):
+    """
+    :return: (args, shell), 不需要shell时args为argv列表, 否则为原始命令
+    """
+    if any(x in SHELL_CHARS for x in cmd):
+        return cmd, True
+    try:
+        argv = shlex.split(cmd)
+    except ValueError:
+        return cmd, True
+    # 变量赋值前缀以及cd/export等shell内置命令也需要shell
+    if not argv or '=' in argv[0] or shutil.which(argv[0]) is None:
+        return cmd, True
+    return argv, False
+
+
+@contextlib.contextmanager
+def pinned(cores):
+    """
+    在with块中把调用线程绑定到cores, 离开时恢复原来的绑定, cores为空时不做任何事.
+    子进程从创建起就继承调用线程的绑定, 任务一启动就创建的线程和子进程也都在绑定的cpu上;
+    os.sched_setaffinity(0, ...)只改变调用线程, 不影响调度进程的其他线程, 也不需要preexec_fn
+    """
+    if not cores or not hasattr(os, 'sched_setaffinity'):
+        yield
+        return
+    default_cores = os.sched_getaffinity(0)
+    try:
+        os.sched_setaffinity(0, cores)
+    except OSError:
+        # 绑定失败时仍然运行任务
+        default_cores = None
+    try:
+        yield
+    finally:
+        if default_cores is not None:
+            os.sched_setaffinity(0, default_cores)
+
+
+def pidfd_child_watcher():
+    """
+    Python 3.12之前asyncio默认的ThreadedChildWatcher为每个子进程启动一个线程等待其退出,
+    系统支持pidfd时返回PidfdChildWatcher, 由事件循环直接等待子进程退出; 否则返回None
+    """
+    if sys.version_info >= (3, 12):
+        # 3.12起支持pidfd时默认就是PidfdChildWatcher
+        return None
+    import asyncio
+    if not hasattr(asyncio, 'PidfdChildWatcher') or not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        # 内核不支持或被seccomp禁止
+        return None
+    return asyncio.PidfdChildWatcher()
+
+
+def signal_process_group(proc, sig):
+    """任务进程以新的会话启动, 向其整个进程组发送信号, 由它派生的进程一起收到"""
+    if proc.returncode is not None:
+        # 组长已被回收后pid可能被复用, 不再发送信号
+        return
+    try:
+        os.killpg(proc.pid, sig)
+    except OSError:
+        pass
+
+
+def kill_process_group(proc):
+    signal_process_group(proc, signal.SIGKILL)
+
+
+class ForkServerProcess(object):
+    """forkserver中启动的任务进程, 提供与psutil.Popen相同的pid/returncode/wait/kill用法"""
+    def __init__(self, pid, exited):
+        self.pid = pid
+        # 进程结束时由ForkServer设置为退出码
+        self.exited = exited
+        try:
+            self.process = psutil.Process(pid)
+        except psutil.Error:
+            # 进程已经结束并被回收
+            self.process = None
+
+    def __getattr__(self, item):
+        # children/oneshot/cpu_percent等交给psutil.Process, 供资源采样使用
+        if item == 'process' or self.process is None:
+            raise psutil.NoSuchProcess(self.pid)
+        return getattr(self.process, item)
+
+    @property
+    def returncode(self):
+        return self.exited.result() if self.exited.done() else None
+
+    def wait(self, timeout=None):
+        return self.exited.result(timeout)
+
+    def is_running(self):
+        return not self.exited.done()
+
+    def kill(self):
+        kill_process_group(self)
+
+
+class ForkServer(object):
+    """
+    调度进程一侧的forkserver客户端: 通过管道发送启动请求, 后台线程接收进程号和退出码.
+    forkserver退出时所有未结束的任务视为失败
+    """
+    def __init__(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        )
+        self.lock = threading.Lock()
+        self.started = dict()
+        self.exited = dict()
+        self.next_id = 0
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            message = json.loads(line.decode('utf-8'))
+            with self.lock:
+                if message['type'] == 'exit':
+                    future = self.exited.pop(message['id'], None)
+                    result = message['returncode']
+                else:
+                    future = self.started.pop(message['id'], None)
+                    result = message.get('pid')
+                    if message['type'] == 'error':
+                        result = OSError(message['message'])
+            if future is None:
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        # forkserver已退出, 等待中的任务视为失败
+        with self.lock:
+            started, exited = list(self.started.values()), list(self.exited.values())
+            self.started.clear()
+            self.exited.clear()
+        for future in started:
+            future.set_exception(OSError('forkserver exited'))
+        for future in exited:
+            future.set_result(-1)
+
+    def spawn(self, args, shell, stdout, stderr, env=None, cores=None):
+        """
+        :param stdout/stderr: 日志文件路径, 由forkserver以追加方式打开
+        :param env: 任务的环境变量, 默认与forkserver相同
+        :param cores: 任务绑定的cpu, 默认不绑定
+        """
+        started, exited = Future(), Future()
+        with self.lock:
+            self.next_id += 1
+            task_id = self.next_id
+            self.started[task_id] = started
+            self.exited[task_id] = exited
+            request = dict(
+                id=task_id, args=args, shell=shell, stdout=stdout, stderr=stderr, cwd=os.getcwd(), env=env,
+                cores=sorted(cores) if cores else None,
+            )
+            self.proc.stdin.write((json.dumps(request) + '\n').encode('utf-8'))
+            self.proc.stdin.flush()
+        return ForkServerProcess(started.result(), exited)
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+
+
+def serve(rfile, wfile):
+    """forkserver主循环: 用posix_spawn启动任务进程, 一个线程统一回收退出的子进程并回报退出码"""
+    cond = threading.Condition()
+    children = dict()
+
+    def reply(message):
+        wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+        wfile.flush()
+
+    def reap():
+        while True:
+            with cond:
+                while not children:
+                    cond.wait()
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                continue
+            with cond:
+                task_id = children.pop(pid, None)
+                if task_id is not None:
+                    reply(dict(type='exit', id=task_id, returncode=os.waitstatus_to_exitcode(status)))
+
+    threading.Thread(target=reap, daemon=True).start()
+    flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+    # posix_spawn创建的进程继承调用线程的cpu绑定, 绑定的任务在启动前临时改变本线程的绑定
+    for line in rfile:
+        request = json.loads(line.decode('utf-8'))
+        argv = ['/bin/sh', '-c', request['args']] if request['shell'] else request['args']
+        file_actions = [
+            (os.POSIX_SPAWN_OPEN, 1, request['stdout'], flags, 0o644),
+            (os.POSIX_SPAWN_OPEN, 2, request['stderr'], flags, 0o644),
+        ]
+        with cond:
+            try:
+                if request['cwd'] != os.getcwd():
+                    os.chdir(request['cwd'])
+                with pinned(request.get('cores')):
+                    pid = os.posix_spawnp(
+                        argv[0], argv, request.get('env') or os.environ, file_actions=file_actions, setsid=True
+                    )
+            except OSError as e:
+                reply(dict(type='error', id=request['id'], message=str(e)))
+                continue
+            children[pid] = request['id']
+            reply(dict(type='started', id=request['id'], pid=pid))
+            cond.notify()
+
+
+if __name__ == '__main__':
+    # 调度进程退出后管道关闭, forkserver随之退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    serve(sys.stdin.buffer, sys.stdout.buffer)
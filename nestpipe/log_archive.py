@@ -0,0 +1,134 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import glob
+import time
+import zlib
+import socket
+import threading
+from collections import deque
+
+INDEX_FIELDS = ['name', 'attempt', 'stream', 'offset', 'length', 'raw_size', 'pid', 'source']
+
+
+class LogArchive(object):
+    """
+    代替每个任务每次运行的stdout/stderr/resource小文件: 每次运行流程只追加写一个归档,
+    logs/archive.<时间>.<节点>.data 由一个个gzip片段首尾相接组成(可直接zcat),
+    logs/archive.<时间>.<节点>.index 记录每个片段所属的任务、第几次运行、输出类型、偏移和长度.
+    先写数据再写索引, 读取时只会看到完整的片段
+    """
+    def __init__(self, log_dir, node=None):
+        node = node or '{}.{}'.format(socket.gethostname(), os.getpid())
+        prefix = os.path.join(log_dir, 'archive.{}.{}'.format(time.strftime('%Y%m%d%H%M%S'), node))
+        os.makedirs(log_dir, exist_ok=True)
+        self.data_file = open(prefix + '.data', 'ab')
+        self.index_file = open(prefix + '.index', 'a')
+        if self.index_file.tell() == 0:
+            self.index_file.write('\t'.join(INDEX_FIELDS) + '\n')
+        self.lock = threading.Lock()
+
+    def add(self, names, attempt, pid, files, source):
+        """
+        :param names: 共用这些日志的任务名, 批量运行时为整批的子任务
+        :param files: [(stdout/stderr/resource, 文件路径)]
+        :param source: 产生日志的Command名, 批量运行时为'leader.batch'
+        """
+        with self.lock:
+            lines = list()
+            for stream, path in files:
+                offset = self.data_file.tell()
+                # wbits=31即gzip格式, 每个片段可以单独解压
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                raw_size = 0
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024*1024), b''):
+                        raw_size += len(chunk)
+                        self.data_file.write(compressor.compress(chunk))
+                self.data_file.write(compressor.flush())
+                length = self.data_file.tell() - offset
+                for name in names:
+                    record = [name, attempt, stream, offset, length, raw_size, pid, source]
+                    lines.append('\t'.join(str(x) for x in record))
+            self.data_file.flush()
+            if lines:
+                self.index_file.write('\n'.join(lines) + '\n')
+                self.index_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.data_file.close()
+            self.index_file.close()
+
+
+def read_index(log_dir, name=None):
+    """读取log_dir中所有归档的索引, 按写入顺序返回记录, name不为空时只返回该任务的记录"""
+    records = list()
+    for index_file in sorted(glob.glob(os.path.join(log_dir, 'archive.*.index'))):
+        data_file = index_file[:-len('.index')] + '.data'
+        with open(index_file) as f:
+            _ = f.readline()
+            for line in f:
+                line_lst = line.rstrip('\n').split('\t')
+                if len(line_lst) != len(INDEX_FIELDS) or (name and line_lst[0] != name):
+                    continue
+                record = dict(zip(INDEX_FIELDS, line_lst))
+                for key in ['attempt', 'offset', 'length', 'raw_size']:
+                    record[key] = int(record[key])
+                record['data_file'] = data_file
+                records.append(record)
+    return records
+
+
+def iter_lines(record, block_size=1024*1024):
+    """直接定位到record对应的片段, 边解压边按行返回, 批量运行时只返回'### 任务名'分隔的该任务部分"""
+    decompressor = zlib.decompressobj(31)
+    batch = record['source'] != record['name']
+    selected = not batch
+    rest = b''
+    with open(record['data_file'], 'rb') as f:
+        f.seek(record['offset'])
+        remain = record['length']
+        while remain >= 0:
+            chunk = f.read(min(block_size, remain))
+            remain -= len(chunk)
+            if chunk:
+                data = decompressor.decompress(chunk)
+            else:
+                # 片段已读完
+                data = decompressor.flush()
+                remain = -1
+            lines = (rest + data).split(b'\n')
+            rest = lines.pop()
+            if remain < 0 and rest:
+                # 最后一行没有换行符
+                lines.append(rest)
+            for line in lines:
+                if batch and line.startswith(b'### '):
+                    selected = line[4:].decode('utf-8', 'replace') == record['name']
+                    continue
+                if selected:
+                    yield line.decode('utf-8', 'replace')
+
+
+def task_log(log_dir, name, attempt=None, streams=None, tail=None):
+    """
+    读取最近一次运行流程时(最新的归档中)该任务的日志
+    :param attempt: 第几次运行, 默认最后一次
+    :param streams: 输出类型列表, 默认全部
+    :param tail: 只返回最后tail行
+    :return: [(record, 行列表)], 没有归档记录时为空
+    """
+    records = read_index(log_dir, name)
+    if not records:
+        return []
+    records = [x for x in records if x['data_file'] == records[-1]['data_file']]
+    if attempt is None:
+        attempt = records[-1]['attempt']
+    result = list()
+    for record in records:
+        if record['attempt'] != attempt or (streams and record['stream'] not in streams):
+            continue
+        lines = deque(iter_lines(record), maxlen=tail) if tail else list(iter_lines(record))
+        result.append((record, list(lines)))
+    return result
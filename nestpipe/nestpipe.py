@@ -4,14 +4,48 @@ import time
 import os
 import configparser
 import psutil
-import queue
 import logging
+import heapq
 from subprocess import PIPE
 import threading
 from threading import Timer, Lock
+from concurrent.futures import ThreadPoolExecutor
 import weakref
 import atexit
 import signal
+import socket
+import json
+import asyncio
+import shlex
+import shutil
+import tempfile
+try:
+    from .state_db import StateDB, main_step
+    from .resource_series import ResourceSeries
+    from .task_cache import TaskCache, split_paths
+    from .shared import SharedWorkspace
+    from .launcher import ForkServer, command_args, kill_process_group, signal_process_group, pinned, \
+        pidfd_child_watcher
+    from .pressure import read_pressure, pressure_available, read_oom_kills
+    from .cpu_affinity import CoreMap, THREAD_ENV
+    from .temp_cleaner import TempCleaner
+    from .log_archive import LogArchive
+    from .status_server import StatusServer
+    from .timeline import EventLog
+except ImportError:
+    # nestpipe.py被直接当作脚本运行
+    from state_db import StateDB, main_step
+    from resource_series import ResourceSeries
+    from task_cache import TaskCache, split_paths
+    from shared import SharedWorkspace
+    from launcher import ForkServer, command_args, kill_process_group, signal_process_group, pinned, \
+        pidfd_child_watcher
+    from pressure import read_pressure, pressure_available, read_oom_kills
+    from cpu_affinity import CoreMap, THREAD_ENV
+    from temp_cleaner import TempCleaner
+    from log_archive import LogArchive
+    from status_server import StatusServer
+    from timeline import EventLog
 
 try:
     import pygraphviz as pgv
@@ -27,9 +61,10 @@ PROCESS_remote = weakref.WeakKeyDictionary()
 def _kill_processes_when_exit():
     print("....Ending....")
     for proc, cmd_name in PROCESS_local.items():
-        if psutil.pid_exists(proc.pid):
+        if proc.returncode is None:
             print('Shutting down running tasks {}:{}'.format(proc.pid, cmd_name))
-            proc.kill()
+            # 结束整个进程组, 包括shell派生的真正干活的进程
+            kill_process_group(proc)
     # 有些已经发起但还没有收进来的无法终止
     for proc in list(PROCESS_remote.keys()):
         cmd_name = PROCESS_remote[proc]
@@ -65,90 +100,656 @@ def set_logger(name='workflow.log', logger_id='x'):
     return logger
 
 
+def read_state_table(outdir):
+    """
+    读取outdir中的状态表cmd_state.txt并回放其后的日志cmd_state.journal和shared/journals/*.journal.
+    各节点的日志之间没有先后顺序, 某个节点已记录成功的任务不会被其他节点日志中的记录覆盖
+    :return: dict, 每个任务最近一次记录的状态, 来自状态表的记录还包含depend和cmd
+    """
+    records = dict()
+    fields = ['state', 'used_time', 'mem', 'cpu', 'pid', 'depend', 'cmd']
+    # 共享模式下每个节点的日志在shared/journals中
+    journal_dir = os.path.join(outdir, 'shared', 'journals')
+    shared_journals = list()
+    if os.path.exists(journal_dir):
+        shared_journals = [os.path.join('shared', 'journals', x) for x in sorted(os.listdir(journal_dir))]
+    # 共享日志中已成功的任务
+    shared_success = set()
+    for each in ['cmd_state.txt', 'cmd_state.journal'] + shared_journals:
+        state_file = os.path.join(outdir, each)
+        if not os.path.exists(state_file):
+            continue
+        with open(state_file, 'r') as f:
+            if each == 'cmd_state.txt':
+                _ = f.readline()
+            for line in f:
+                line_lst = line.rstrip('\n').split('\t')
+                # 崩溃时可能只写了半行
+                if len(line_lst) < 6:
+                    continue
+                if each in shared_journals:
+                    if line_lst[0] in shared_success:
+                        continue
+                    if line_lst[1] == 'success':
+                        shared_success.add(line_lst[0])
+                records.setdefault(line_lst[0], dict()).update(zip(fields, line_lst[1:]))
+    return records
+
+
+class ResourceSampler(object):
+    """
+    所有运行中的任务共用一个采样线程, 每个周期对每个任务的整个进程树采样一次,
+    周期取已注册任务中最小的monitor_time_step
+    """
+    def __init__(self):
+        self.commands = set()
+        self.cond = threading.Condition(Lock())
+        self.thread = None
+
+    def register(self, cmd):
+        with self.cond:
+            self.commands.add(cmd)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def unregister(self, cmd):
+        with self.cond:
+            self.commands.discard(cmd)
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.commands:
+                    self.cond.wait()
+                commands = list(self.commands)
+            for cmd in commands:
+                cmd._sample_resource()
+            time.sleep(max(min(x.monitor_time_step for x in commands), 0.1))
+
+
+SAMPLER = ResourceSampler()
+
+
 class Command(object):
     def __init__(self, cmd, name, timeout=3600*24*10, outdir=os.getcwd(),
-                 monitor_resource=True, monitor_time_step=2, logger=None, **kwargs):
+                 monitor_resource=True, monitor_time_step=2, logger=None, log_max_size=0, series=None,
+                 executor=None, cpu=0, log_dir=None, **kwargs):
         self.name = name
         self.cmd = cmd
+        # 申报的cpu数目, 绑定cpu时按此分配
+        self.cpu = float(cpu)
         self.proc = None
+        # stdout和stderr直接写入日志文件, 这里记录日志文件路径
         self.stdout = None
         self.stderr = None
+        # 大于0时, 单个日志文件超过该字节数后只保留最后的log_max_size字节
+        self.log_max_size = int(log_max_size)
+        # 日志文件所在目录, 默认为outdir/logs
+        self.log_dir = log_dir
+        # 任务在哪里执行, 默认在本机
+        self.executor = executor if executor is not None else LocalExecutor()
+        # 任务进程启动后被设置
+        self.started = threading.Event()
         self.timeout = int(timeout)
         self.used_time = 0
+        self.start_time = None
+        self.end_time = None
         self.max_mem = 0
         self.max_cpu = 0
+        # 最近一次采样的cpu和内存, 内存单位M
+        self.cur_cpu = 0
+        self.cur_mem = 0
+        # 整个进程树累计读写的字节数(包括已结束的子进程), 以及读写速率的峰值, 单位M/s
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.max_io_rate = 0
+        self._io_seen = dict()
+        self._io_time = None
+        # 结束原因: success/timeout/oom/killed/error/not_started, 每次运行结束后设置
+        self.timed_out = False
+        self.exit_class = None
+        self._oom_kills = None
         self.monitor = monitor_resource
         self.monitor_time_step = int(monitor_time_step)
+        self._tree_cache = dict()
+        # 资源采样的时间序列写入ResourceSeries, 不再为每个任务单独写resource.txt
+        self.series = series
         self.outdir = outdir
         if not logger:
             self.logger = set_logger(name=os.path.join(self.outdir, 'command.log'))
         else:
             self.logger = logger
 
-    def _monitor_resource(self):
-        while self.proc.is_running():
+    def _sample_resource(self):
+        # 由ResourceSampler周期调用, 统计整个进程树的cpu和内存, 而不仅仅是shell进程本身
+        try:
+            tree = [self.proc] + self.proc.children(recursive=True)
+        except psutil.Error:
+            return
+        used_cpu = 0
+        memory = 0
+        rss = 0
+        threads = 0
+        tree_cache = dict()
+        for proc in tree:
+            # 复用上一次的Process对象, cpu_percent(None)才能返回两次采样之间的cpu使用率
+            proc = self._tree_cache.get(proc.pid, proc)
             try:
-                # if os.name == 'posix':
-                #     cpu_num = self.proc.cpu_num()
-                # elif os.name == 'nt':
-                #     cpu_num = psutil.cpu_count()
-                # else:
-                #     cpu_num = 0
-                cpu_percent = self.proc.cpu_percent(self.monitor_time_step)
-                used_cpu = round(cpu_percent*0.01, 4)
-                if used_cpu > self.max_cpu:
-                    self.max_cpu = used_cpu
-                memory_obj = self.proc.memory_full_info()
-                # memory = (memory_obj.vms - memory_obj.shared)/1024/1024
-                # memory = round(memory_obj.vms/1024/1024, 4)
-                memory = round(memory_obj.uss/1024/1024, 4)
-                if memory > self.max_mem:
-                    self.max_mem = memory
-            except Exception as e:
-                # print('Failed to capture cpu/mem info for: ', e)
+                with proc.oneshot():
+                    used_cpu += proc.cpu_percent(None)*0.01
+                    try:
+                        memory_obj = proc.memory_full_info()
+                        memory += memory_obj.uss
+                    except psutil.AccessDenied:
+                        memory_obj = proc.memory_info()
+                        memory += memory_obj.rss
+                    rss += memory_obj.rss
+                    threads += proc.num_threads()
+                    if hasattr(proc, 'io_counters'):
+                        try:
+                            io = proc.io_counters()
+                            self._io_seen[proc.pid] = (io.read_bytes, io.write_bytes)
+                        except psutil.AccessDenied:
+                            pass
+                tree_cache[proc.pid] = proc
+            except psutil.Error:
+                pass
+        self._tree_cache = tree_cache
+        now = time.time()
+        read_bytes = sum(x[0] for x in self._io_seen.values())
+        write_bytes = sum(x[1] for x in self._io_seen.values())
+        if self._io_time is not None and now > self._io_time:
+            io_rate = (read_bytes + write_bytes - self.read_bytes - self.write_bytes)/(now - self._io_time)/1024/1024
+            self.max_io_rate = max(self.max_io_rate, round(io_rate, 4))
+        self.read_bytes, self.write_bytes, self._io_time = read_bytes, write_bytes, now
+        if self.series is not None:
+            self.series.write(self.name, self.proc.pid, now, used_cpu, rss, memory,
+                              read_bytes, write_bytes, threads)
+        used_cpu = round(used_cpu, 4)
+        memory = round(memory/1024/1024, 4)
+        self.cur_cpu = used_cpu
+        self.cur_mem = memory
+        if used_cpu > self.max_cpu:
+            self.max_cpu = used_cpu
+        if memory > self.max_mem:
+            self.max_mem = memory
+
+    def _log_dir(self):
+        log_dir = self.log_dir or os.path.join(self.outdir, 'logs')
+        if not os.path.exists(log_dir):
+            try:
+                os.mkdir(log_dir)
+            except FileExistsError:
+                pass
+        return log_dir
+
+    def _stream_log(self, pipe, log_file):
+        # 边读边写, 内存占用不超过一个读取块; 文件超过上限的两倍时截断, 只保留最后log_max_size字节
+        size = 0
+        while True:
+            chunk = os.read(pipe.fileno(), 65536)
+            if not chunk:
+                break
+            log_file.write(chunk)
+            size += len(chunk)
+            if size > 2 * self.log_max_size:
+                log_file.seek(size - self.log_max_size)
+                tail = log_file.read(self.log_max_size)
+                log_file.seek(0)
+                log_file.truncate()
+                log_file.write(b'...truncated...\n' + tail)
+                size = log_file.tell()
+        pipe.close()
+
+    async def _stream_log_async(self, reader, log_file):
+        # 与_stream_log相同, 在事件循环中读取asyncio子进程的输出
+        size = 0
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
                 break
+            log_file.write(chunk)
+            size += len(chunk)
+            if size > 2 * self.log_max_size:
+                log_file.seek(size - self.log_max_size)
+                tail = log_file.read(self.log_max_size)
+                log_file.seek(0)
+                log_file.truncate()
+                log_file.write(b'...truncated...\n' + tail)
+                size = log_file.tell()
+
+    def _before_run(self):
+        self.timed_out = False
+        self.exit_class = None
+        # 第一次采样的读写速率从进程启动时算起
+        self.read_bytes = self.write_bytes = self.max_io_rate = 0
+        self._io_seen = dict()
+        self._io_time = self.start_time
+        # 只有本机任务能通过系统的oom_kill计数确认是否被OOM killer结束
+        self._oom_kills = read_oom_kills() if self.executor.name == 'local' else None
+
+    def _after_run(self):
+        # 远程任务的结束原因由worker判断后回传
+        if self.exit_class is None:
+            self.exit_class = self.classify_exit()
+
+    def classify_exit(self):
+        """根据退出码判断结束原因"""
+        if self.proc is None or self.proc.returncode is None:
+            return 'not_started'
+        returncode = self.proc.returncode
+        if returncode == 0:
+            return 'success'
+        if self.timed_out:
+            return 'timeout'
+        # 直接被SIGKILL结束时退出码为-9, 经过shell时为137
+        if returncode in (-signal.SIGKILL, 128 + signal.SIGKILL):
+            oom_kills = read_oom_kills()
+            if self._oom_kills is None or oom_kills is None or oom_kills > self._oom_kills:
+                return 'oom'
+            return 'killed'
+        if returncode < 0:
+            return 'killed'
+        return 'error'
 
     def run(self):
-        start_time = time.time()
+        start_time = self.start_time = time.time()
         self.logger.warning("RunStep: {}".format(self.name))
         self.logger.info("RunCmd: {}".format(self.cmd))
-        # submit task
-        self.proc = psutil.Popen(self.cmd, shell=True, stderr=PIPE, stdout=PIPE)
-        PROCESS_local[self.proc] = self.name
-        if self.monitor:
-            thread = threading.Thread(target=self._monitor_resource, daemon=True)
-            thread.start()
-        timer = Timer(self.timeout, self.proc.kill)
-        try:
-            timer.start()
-            self.stdout, self.stderr = self.proc.communicate()
-            if self.monitor:
-                thread.join()
-        finally:
-            timer.cancel()
-        self._write_log()
-        end_time = time.time()
+        self._before_run()
+        self.executor.run(self)
+        self._after_run()
+        end_time = self.end_time = time.time()
         self.used_time = round(end_time - start_time, 4)
 
-    def _write_log(self):
-        log_dir = os.path.join(self.outdir, 'logs')
-        if not os.path.exists(log_dir):
-            try:
-                os.mkdir(log_dir)
-            except FileExistsError:
-                pass
+    async def run_async(self, pool=None):
+        # asyncio引擎使用, 执行器没有异步实现时(如远程worker)在线程池pool中运行, pool应能容纳所有同时运行的任务
+        start_time = self.start_time = time.time()
+        self.logger.warning("RunStep: {}".format(self.name))
+        self.logger.info("RunCmd: {}".format(self.cmd))
+        self._before_run()
+        if hasattr(self.executor, 'run_async'):
+            await self.executor.run_async(self)
+        else:
+            await asyncio.get_running_loop().run_in_executor(pool, self.executor.run, self)
+        self._after_run()
+        end_time = self.end_time = time.time()
+        self.used_time = round(end_time - start_time, 4)
 
-        prefix = os.path.join(self.outdir, 'logs', self.name+'.'+str(self.proc.pid))
-        if self.stderr:
-            with open(prefix+'.stderr.txt', 'wb') as f:
-                f.write(self.stderr)
-        if self.stdout:
-            with open(prefix+'.stdout.txt', 'wb') as f:
-                f.write(self.stdout)
-        if self.max_cpu or self.max_mem:
+    def _write_log(self):
+        # 删除空的日志文件
+        for each in [self.stdout, self.stderr]:
+            if each and os.path.exists(each) and os.path.getsize(each) == 0:
+                os.remove(each)
+        prefix = os.path.join(self._log_dir(), self.name+'.'+str(self.proc.pid))
+        if (self.max_cpu or self.max_mem) and self.series is None:
             with open(prefix+'.resource.txt', 'w') as f:
                 f.write('max_cpu: {}\n'.format(self.max_cpu))
                 f.write('max_mem: {}M\n'.format(round(self.max_mem, 4)))
+                f.write('read: {}M\n'.format(round(self.read_bytes/1024/1024, 4)))
+                f.write('write: {}M\n'.format(round(self.write_bytes/1024/1024, 4)))
+                f.write('max_io_rate: {}M/s\n'.format(self.max_io_rate))
+
+
+class LocalExecutor(object):
+    """
+    在本机启动任务进程: 不需要shell的命令直接exec, 每个任务在新的会话中启动, 结束时可杀掉整个进程组;
+    提供forkserver时由其创建进程, 但需要截断日志(log_max_size)的任务仍由调度进程直接启动;
+    提供core_map时按任务申报的cpu数目分配互不重叠的cpu并绑定
+    """
+    name = 'local'
+
+    def __init__(self, forkserver=None, core_map=None, thread_env=False):
+        self.forkserver = forkserver
+        self.core_map = core_map
+        # 绑定cpu时是否同时设置OMP_NUM_THREADS等环境变量
+        self.thread_env = thread_env
+        # (事件循环, asyncio.Lock): asyncio引擎在事件循环线程中启动子进程, 绑定cpu时该线程的绑定被临时改变, 启动过程不能交错
+        self.spawn_lock = None
+
+    def _pin(self, cmd):
+        # 返回分配给任务的cpu, 以及设置了线程数的环境变量
+        if self.core_map is None:
+            return None, None
+        cores = self.core_map.allocate(cmd.name, cmd.cpu)
+        if cores is None:
+            return None, None
+        env = None
+        if self.thread_env:
+            env = dict(os.environ)
+            env.update({x: str(len(cores)) for x in THREAD_ENV})
+        return cores, env
+
+    @staticmethod
+    def _log_pin(cmd, cores):
+        # 子进程创建时已继承绑定的cpu(见launcher.pinned), 这里只记录
+        if cores:
+            cmd.logger.info('Pin {} to cpu {}'.format(cmd.name, ','.join(str(x) for x in cores)))
+
+    def _unpin(self, cmd, cores):
+        if cores:
+            self.core_map.release(cmd.name)
+
+    def hello(self):
+        # io为0表示不限制I/O
+        return dict(host=socket.gethostname(), cpu=psutil.cpu_count(), mem=psutil.virtual_memory().available, io=0)
+
+    def run(self, cmd):
+        # 先以任务名建立日志文件, 获得pid后再重命名
+        prefix = os.path.join(cmd._log_dir(), cmd.name)
+        stdout = open(prefix + '.stdout.txt', 'w+b')
+        stderr = open(prefix + '.stderr.txt', 'w+b')
+        streams = list()
+        args, shell = command_args(cmd.cmd)
+        cores, env = self._pin(cmd)
+        try:
+            # submit task
+            if cmd.log_max_size > 0:
+                with pinned(cores):
+                    cmd.proc = psutil.Popen(args, shell=shell, stderr=PIPE, stdout=PIPE, start_new_session=True,
+                                            env=env)
+                for pipe, log_file in [(cmd.proc.stdout, stdout), (cmd.proc.stderr, stderr)]:
+                    thread = threading.Thread(target=cmd._stream_log, args=(pipe, log_file), daemon=True)
+                    thread.start()
+                    streams.append(thread)
+            elif self.forkserver is not None:
+                cmd.proc = self.forkserver.spawn(
+                    args, shell, prefix + '.stdout.txt', prefix + '.stderr.txt', env=env, cores=cores
+                )
+            else:
+                with pinned(cores):
+                    cmd.proc = psutil.Popen(args, shell=shell, stderr=stderr, stdout=stdout, start_new_session=True,
+                                            env=env)
+            self._log_pin(cmd, cores)
+            PROCESS_local[cmd.proc] = cmd.name
+            cmd.started.set()
+            cmd.stdout = prefix + '.' + str(cmd.proc.pid) + '.stdout.txt'
+            cmd.stderr = prefix + '.' + str(cmd.proc.pid) + '.stderr.txt'
+            os.replace(prefix + '.stdout.txt', cmd.stdout)
+            os.replace(prefix + '.stderr.txt', cmd.stderr)
+            if cmd.monitor:
+                SAMPLER.register(cmd)
+            timer = Timer(cmd.timeout, self._timeout, args=(cmd,))
+            try:
+                timer.start()
+                cmd.proc.wait()
+                _ = [x.join() for x in streams]
+            finally:
+                timer.cancel()
+                if cmd.monitor:
+                    SAMPLER.unregister(cmd)
+        finally:
+            stdout.close()
+            stderr.close()
+            self._unpin(cmd, cores)
+        cmd._write_log()
+
+    @staticmethod
+    def _timeout(cmd):
+        cmd.timed_out = True
+        cmd.logger.warning('{} timed out after {}s'.format(cmd.name, cmd.timeout))
+        kill_process_group(cmd.proc)
+
+    async def _spawn_async(self, cmd, args, shell, stdout, stderr, env, cores):
+        if self.forkserver is not None and cmd.log_max_size <= 0:
+            proc = await asyncio.get_running_loop().run_in_executor(
+                None, self.forkserver.spawn, args, shell, stdout.name, stderr.name, env, cores
+            )
+            return proc, asyncio.wrap_future(proc.exited)
+        if cmd.log_max_size > 0:
+            stdout = stderr = asyncio.subprocess.PIPE
+        if self.core_map is None:
+            proc = await self._create_subprocess(args, shell, stdout, stderr, env)
+        else:
+            # 事件循环线程的绑定被临时收窄期间, 不绑定cpu的任务也不能启动
+            loop = asyncio.get_running_loop()
+            if self.spawn_lock is None or self.spawn_lock[0] is not loop:
+                self.spawn_lock = (loop, asyncio.Lock())
+            async with self.spawn_lock[1]:
+                with pinned(cores):
+                    proc = await self._create_subprocess(args, shell, stdout, stderr, env)
+        return AsyncProcess(proc), asyncio.ensure_future(proc.wait())
+
+    @staticmethod
+    async def _create_subprocess(args, shell, stdout, stderr, env):
+        if shell:
+            return await asyncio.create_subprocess_shell(
+                args, stdout=stdout, stderr=stderr, start_new_session=True, env=env
+            )
+        return await asyncio.create_subprocess_exec(
+            *args, stdout=stdout, stderr=stderr, start_new_session=True, env=env
+        )
+
+    async def run_async(self, cmd):
+        # 与run相同, 但进程的启动、等待、超时和日志读取都在事件循环中完成, 不需要额外的线程
+        prefix = os.path.join(cmd._log_dir(), cmd.name)
+        stdout = open(prefix + '.stdout.txt', 'w+b')
+        stderr = open(prefix + '.stderr.txt', 'w+b')
+        streams = list()
+        args, shell = command_args(cmd.cmd)
+        cores, env = self._pin(cmd)
+        try:
+            cmd.proc, exited = await self._spawn_async(cmd, args, shell, stdout, stderr, env, cores)
+            self._log_pin(cmd, cores)
+            if cmd.log_max_size > 0:
+                streams = [
+                    asyncio.ensure_future(cmd._stream_log_async(cmd.proc.proc.stdout, stdout)),
+                    asyncio.ensure_future(cmd._stream_log_async(cmd.proc.proc.stderr, stderr)),
+                ]
+            PROCESS_local[cmd.proc] = cmd.name
+            cmd.started.set()
+            cmd.stdout = prefix + '.' + str(cmd.proc.pid) + '.stdout.txt'
+            cmd.stderr = prefix + '.' + str(cmd.proc.pid) + '.stderr.txt'
+            os.replace(prefix + '.stdout.txt', cmd.stdout)
+            os.replace(prefix + '.stderr.txt', cmd.stderr)
+            if cmd.monitor:
+                SAMPLER.register(cmd)
+            try:
+                # shield避免超时取消时连带取消forkserver的Future
+                await asyncio.wait_for(asyncio.shield(exited), cmd.timeout)
+            except asyncio.TimeoutError:
+                self._timeout(cmd)
+                await exited
+            finally:
+                if cmd.monitor:
+                    SAMPLER.unregister(cmd)
+            if streams:
+                await asyncio.gather(*streams)
+        finally:
+            stdout.close()
+            stderr.close()
+            self._unpin(cmd, cores)
+        cmd._write_log()
+
+
+class AsyncProcess(object):
+    """
+    asyncio子进程的包装, 提供与psutil.Popen相同的pid/returncode/kill/is_running,
+    其余属性如children/oneshot/cpu_percent交给psutil.Process, 供资源采样使用
+    """
+    def __init__(self, proc):
+        self.proc = proc
+        self.pid = proc.pid
+        try:
+            self.process = psutil.Process(proc.pid)
+        except psutil.Error:
+            # 进程已经结束并被回收
+            self.process = None
+
+    def __getattr__(self, item):
+        if item == 'process' or self.process is None:
+            raise psutil.NoSuchProcess(self.pid)
+        return getattr(self.process, item)
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    def is_running(self):
+        return self.proc.returncode is None
+
+    def kill(self):
+        kill_process_group(self)
+
+
+class BatchProcess(object):
+    """批量运行时单个子命令的结果, 代替Command.proc记录其退出码, pid为整批共用的shell进程"""
+    def __init__(self, pid, returncode):
+        self.pid = pid
+        self.returncode = returncode
+
+    def is_running(self):
+        return False
+
+
+def batch_script(names, cmds, status_file):
+    """
+    把多个命令合并成一个shell脚本依次运行, 每个子命令在子shell中执行,
+    结束后把 任务名/退出码/开始时间/结束时间 追加到status_file, stdout和stderr中以'### 任务名'分隔
+    """
+    lines = list()
+    # bash5的EPOCHREALTIME无需启动date进程, 其他shell退回到date
+    now = '${EPOCHREALTIME:-$(date +%s.%N)}'
+    for name, cmd in zip(names, cmds):
+        quoted = shlex.quote(name)
+        lines.append("echo '### '{0}; echo '### '{0} >&2".format(quoted))
+        lines.append('_start={}'.format(now))
+        lines.append('(\n{}\n)'.format(cmd))
+        lines.append("_rc=$?; printf '%s\\t%s\\t%s\\t%s\\n' {} $_rc $_start {} >> {}".format(
+            quoted, now, shlex.quote(status_file)))
+    return '\n'.join(lines) + '\n'
+
+
+def send_message(stream, message):
+    stream.write((json.dumps(message) + '\n').encode('utf-8'))
+    stream.flush()
+
+
+def recv_message(stream):
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+class RemoteProcess(object):
+    """远程任务进程在调度端的代理, 提供与psutil.Popen相同的pid/returncode/kill/is_running"""
+    def __init__(self, stream, pid, lock):
+        self.stream = stream
+        self.pid = pid
+        self.returncode = None
+        self.lock = lock
+
+    @property
+    def pid_exists(self):
+        return self.returncode is None
+
+    def is_running(self):
+        return self.returncode is None
+
+    def kill(self):
+        if self.returncode is None:
+            try:
+                with self.lock:
+                    send_message(self.stream, dict(type='kill'))
+            except OSError:
+                pass
+
+
+class RemoteExecutor(object):
+    """
+    通过TCP把任务交给运行在其他节点上的worker agent(nestpipe worker)执行,
+    agent回传进程号, 资源采样和退出码; 连接断开时agent会杀掉该任务.
+    每个连接先发送与agent相同的口令, 口令不对时agent拒绝运行任何命令
+    """
+    def __init__(self, host, port, token=None):
+        self.host = host
+        self.port = int(port)
+        self.name = '{}:{}'.format(host, port)
+        self.token = token
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port))
+        stream = sock.makefile('rwb')
+        try:
+            send_message(stream, dict(type='auth', token=self.token))
+            hello = recv_message(stream)
+        except (OSError, ValueError) as e:
+            stream.close()
+            sock.close()
+            raise OSError('failed to talk with worker: {}'.format(e))
+        if hello is None or hello.get('type') == 'error':
+            stream.close()
+            sock.close()
+            raise OSError('rejected by worker: {}'.format(hello.get('message') if hello else 'connection closed'))
+        return sock, stream, hello
+
+    def hello(self):
+        # 口令正确时agent报告自己的cpu和内存
+        sock, stream, hello = self._connect()
+        stream.close()
+        sock.close()
+        return hello
+
+    def run(self, cmd):
+        lock = Lock()
+        try:
+            sock, stream, _ = self._connect()
+        except OSError as e:
+            cmd.logger.warning('Failed to connect worker {} for {}: {}'.format(self.name, cmd.name, e))
+            cmd.proc = RemoteProcess(None, None, lock)
+            cmd.proc.returncode = -1
+            return
+        try:
+            with lock:
+                send_message(stream, dict(
+                    type='run', name=cmd.name, cmd=cmd.cmd, outdir=cmd.outdir, timeout=cmd.timeout,
+                    monitor_resource=cmd.monitor, monitor_time_step=cmd.monitor_time_step,
+                    log_max_size=cmd.log_max_size, cpu=cmd.cpu,
+                ))
+            while True:
+                try:
+                    message = recv_message(stream)
+                except (OSError, ValueError):
+                    message = None
+                if message is None:
+                    # 与agent的连接中断, 任务按失败处理
+                    cmd.logger.warning('Lost connection with worker {} for {}'.format(self.name, cmd.name))
+                    if cmd.proc is None:
+                        cmd.proc = RemoteProcess(stream, None, lock)
+                    cmd.proc.returncode = -1
+                    break
+                if message['type'] == 'started':
+                    cmd.proc = RemoteProcess(stream, message['pid'], lock)
+                    PROCESS_remote[cmd.proc] = cmd.name
+                    cmd.started.set()
+                elif message['type'] == 'sample':
+                    cmd.max_cpu = message['max_cpu']
+                    cmd.max_mem = message['max_mem']
+                    cmd.cur_cpu = message.get('cur_cpu', 0)
+                    cmd.cur_mem = message.get('cur_mem', 0)
+                    cmd.read_bytes = message.get('read_bytes', 0)
+                    cmd.write_bytes = message.get('write_bytes', 0)
+                    cmd.max_io_rate = message.get('max_io_rate', 0)
+                elif message['type'] == 'exit':
+                    if cmd.proc is None:
+                        cmd.proc = RemoteProcess(stream, None, lock)
+                    cmd.max_cpu = message['max_cpu']
+                    cmd.max_mem = message['max_mem']
+                    cmd.read_bytes = message.get('read_bytes', 0)
+                    cmd.write_bytes = message.get('write_bytes', 0)
+                    cmd.max_io_rate = message.get('max_io_rate', 0)
+                    cmd.stdout = message['stdout']
+                    cmd.stderr = message['stderr']
+                    cmd.proc.returncode = message['returncode']
+                    cmd.timed_out = message.get('timed_out', False)
+                    cmd.exit_class = message.get('exit_class')
+                    break
+        finally:
+            stream.close()
+            sock.close()
 
 
 class CommandNetwork(object):
@@ -166,7 +767,9 @@ class CommandNetwork(object):
 
     def orphans(self):
         independent_cmds = list()
-        for name in self.names():
+        names = self.names()
+        name_set = set(names)
+        for name in names:
             if 'depend' not in self.parser[name]:
                 independent_cmds.append(name)
             else:
@@ -175,7 +778,7 @@ class CommandNetwork(object):
                     independent_cmds.append(name)
                 else:
                     for each in depend.split(','):
-                        if each not in self.names():
+                        if each.strip() not in name_set:
                             raise Exception(f'Step "{each}" is not in your pipeline! A spelling mistake?')
         return independent_cmds
 
@@ -218,13 +821,28 @@ class CommandNetwork(object):
             tmp_dict['check_resource_before_run'] = self.parser.getboolean('mode', 'check_resource_before_run')
         else:
             tmp_dict['check_resource_before_run'] = self.parser.getboolean(name, 'check_resource_before_run')
+        if 'log_max_size' not in tmp_dict:
+            tmp_dict['log_max_size'] = self.parser.getint('mode', 'log_max_size', fallback=0)
+        else:
+            tmp_dict['log_max_size'] = self.parser.getint(name, 'log_max_size')
+        # 重试策略: 哪些结束原因可以重试, 哪些退出码不重试, OOM后内存申报的放大倍数, 重试前等待的秒数(指数增长)
+        for key, fallback in [('retry_on', 'oom,timeout,killed,error'), ('no_retry_codes', '126,127')]:
+            value = tmp_dict[key] if key in tmp_dict else self.parser.get('mode', key, fallback=fallback)
+            tmp_dict[key] = [x.strip() for x in value.split(',') if x.strip()]
+        tmp_dict['no_retry_codes'] = [int(x) for x in tmp_dict['no_retry_codes']]
+        # I/O权重, 与[mode]中的io_budget单位相同, 如预计的读写速率M/s
+        for key, fallback in [('io', 0), ('oom_mem_factor', 1.5), ('retry_backoff', 0), ('retry_backoff_max', 3600)]:
+            if key not in tmp_dict:
+                tmp_dict[key] = self.parser.getfloat('mode', key, fallback=fallback)
+            else:
+                tmp_dict[key] = self.parser.getfloat(name, key)
         return tmp_dict
 
 
 class CheckResource(object):
     @staticmethod
     def available_mem():
-        return psutil.virtual_memory().free
+        return psutil.virtual_memory().available
 
     @staticmethod
     def available_cpu():
@@ -247,6 +865,47 @@ class CheckResource(object):
             time.sleep(3)
 
 
+class ResourceLedger(object):
+    """
+    记录每个运行中任务申报的cpu/mem/io, 派发任务时预留资源, 任务结束时释放.
+    预留和释放由调用方在同一把锁内完成, 因此同时派发的任务不会重复使用同一份资源.
+    total_io为节点的I/O预算, 不设置时不限制; 超出预算的I/O密集任务继续排队, 先派发其后的cpu密集任务
+    """
+    def __init__(self, total_cpu=None, total_mem=None, total_io=None):
+        self.total_cpu = float(total_cpu) if total_cpu else psutil.cpu_count()
+        # 以available而非free内存作为上限, free不包含可回收的缓存
+        self.total_mem = float(total_mem) if total_mem else psutil.virtual_memory().available
+        self.total_io = float(total_io) if total_io else None
+        self.used_cpu = 0
+        self.used_mem = 0
+        self.used_io = 0
+        self.reserved = dict()
+        # 每释放一次资源加1, 版本不变时上次放不下的任务这次仍放不下
+        self.version = 0
+
+    def fits(self, cpu, mem, io=0):
+        return self.used_cpu + float(cpu) <= self.total_cpu \
+            and self.used_mem + float(mem) <= self.total_mem \
+            and (self.total_io is None or self.used_io + float(io) <= self.total_io)
+
+    def reserve(self, name, cpu, mem, force=False, io=0):
+        if not force and not self.fits(cpu, mem, io):
+            return False
+        self.reserved[name] = (float(cpu), float(mem), float(io))
+        self.used_cpu += float(cpu)
+        self.used_mem += float(mem)
+        self.used_io += float(io)
+        return True
+
+    def release(self, name):
+        if name in self.reserved:
+            cpu, mem, io = self.reserved.pop(name)
+            self.used_cpu -= cpu
+            self.used_mem -= mem
+            self.used_io -= io
+            self.version += 1
+
+
 class StateGraph(object):
     def __init__(self, state):
         self.state = state
@@ -258,6 +917,7 @@ class StateGraph(object):
             running='#9F79EE',
             queueing='#87CEFF',
             killed='red',
+            suspended='#FF8C00',
             outdoor='#A8A8A8',
         )
 
@@ -337,35 +997,367 @@ class StateGraph(object):
         self.graph.draw(path=img_file, format=img_fmt, prog='dot')
 
 
+class CollapsedStateGraph(StateGraph):
+    """
+    按主步骤(任务名中'_'之前的部分)合并节点, 每个节点显示各状态的任务数和累计耗时,
+    绘图耗时只与步骤数有关, 与任务数无关
+    """
+    # 同一步骤中有多种状态时, 节点颜色取排在前面的状态
+    status_order = ['failed', 'killed', 'suspended', 'running', 'queueing', 'outdoor', 'success']
+
+    def __init__(self, state):
+        super().__init__(state)
+        self.steps = self._group_steps()
+
+    def _group_steps(self):
+        steps = dict()
+        for node, cmd_info in self.state.items():
+            step = node.split('_', 1)[0]
+            step_info = steps.setdefault(step, dict(counts=dict(), used_time=0, depend=set()))
+            status = cmd_info['state']
+            step_info['counts'][status] = step_info['counts'].get(status, 0) + 1
+            try:
+                step_info['used_time'] += float(cmd_info['used_time'])
+            except (TypeError, ValueError):
+                pass
+            for each in cmd_info['depend'].strip().split(','):
+                if each and each.split('_', 1)[0] != step:
+                    step_info['depend'].add(each.split('_', 1)[0])
+        return steps
+
+    def _step_status(self, counts):
+        for status in self.status_order:
+            if status in counts:
+                return status
+        return list(counts.keys())[0]
+
+    def _add_nodes(self):
+        for step, step_info in self.steps.items():
+            status = self._step_status(step_info['counts'])
+            color = self.color_dict.get(status, '#A8A8A8')
+            self.used_colors[status] = color
+            node_detail = [step]
+            node_detail += ['{}: {}'.format(k, v) for k, v in sorted(step_info['counts'].items())]
+            if step_info['used_time'] > 0:
+                node_detail.append(str(round(step_info['used_time'], 2)) + 's')
+            self.graph.add_node(
+                step,
+                tooltip='{} tasks'.format(sum(step_info['counts'].values())),
+                shape="box",
+                style="rounded, filled",
+                fillcolor=color,
+                color="mediumseagreen",
+                label='\n'.join(node_detail)
+            )
+
+    def _add_edges(self):
+        for target, step_info in self.steps.items():
+            if step_info['depend']:
+                if self._step_status(step_info['counts']) == 'success':
+                    color = 'green'
+                else:
+                    color = '#4D4D4D'
+                self.graph.add_edges_from(zip(step_info['depend'], [target]*len(step_info['depend'])), color=color)
+            else:
+                self.graph.add_edge('Input', target, color='green')
+
+
+def draw_state_graph(state, img_file='state.svg', step=None, collapse=False):
+    """
+    :param state: RunCommands.state格式的状态字典
+    :param step: 只画某个主步骤下的任务, 用于从合并视图中查看某一步骤的细节
+    :param collapse: 是否按主步骤合并节点
+    """
+    if step:
+        state = {k: v for k, v in state.items() if k == step or k.startswith(step + '_')}
+        # 来自其他步骤的依赖显示为输入
+        state = {k: dict(v, depend=','.join(x for x in v['depend'].split(',') if x in state))
+                 for k, v in state.items()}
+    if collapse:
+        CollapsedStateGraph(state).draw(img_file)
+    else:
+        StateGraph(state).draw(img_file)
+
+
+class StateRenderer(object):
+    """
+    在后台线程中绘制状态图, 两次绘图至少间隔interval秒, 期间的多次更新合并为一次,
+    绘图时不持有调度锁, 先画到临时文件再重命名
+    """
+    def __init__(self, get_state, img_file='state.svg', interval=10, collapse=False):
+        self.get_state = get_state
+        self.img_file = img_file
+        self.interval = interval
+        self.collapse = collapse
+        self.changed = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def notify(self):
+        self.changed.set()
+
+    def _loop(self):
+        while not self.stopped.is_set():
+            self.changed.wait()
+            if self.stopped.is_set():
+                break
+            self.changed.clear()
+            self.render()
+            self.stopped.wait(self.interval)
+
+    def render(self):
+        with self.lock:
+            state = self.get_state()
+            root, ext = os.path.splitext(self.img_file)
+            tmp_file = root + '.tmp' + ext
+            try:
+                draw_state_graph(state, tmp_file, collapse=self.collapse)
+                os.replace(tmp_file, self.img_file)
+            except Exception as e:
+                print('Failed to draw state graph: {}'.format(e))
+
+    def stop(self):
+        # 停止后台线程, 并按最终状态再画一次
+        if self.thread is not None and not self.stopped.is_set():
+            self.stopped.set()
+            self.changed.set()
+            self.thread.join()
+            self.render()
+
+
 class RunCommands(CommandNetwork):
     __LOCK__ = Lock()
 
     def __init__(self, cmd_config, outdir=os.getcwd(), timeout=10, logger=None, draw_state_graph=True):
         super().__init__(cmd_config)
+        # 可选的forkserver, 在调度进程占用的内存还很少时启动, 之后由它创建所有本机任务进程
+        if self.parser.get('mode', 'launcher', fallback='direct') == 'forkserver':
+            self.forkserver = ForkServer()
+        else:
+            self.forkserver = None
         self.end = False
         self.ever_queued = set()
-        self.queue = self.__init_queue()
+        # 等待重试的任务, (可以重新派发的时间, 队列元素)组成的最小堆
+        self.delayed = list()
+        # 已运行的次数和缓存key, 任务失败后按重试策略重新排队时保留
+        self.retrying = dict()
+        self.attempt_file = None
+        # 状态变化以事件的形式推送给这些函数, 如StatusServer.publish
+        self.event_listeners = list()
+        # 任务最近一次进入就绪队列的时间, 用于计算派发延迟
+        self.ready_time = dict()
+        # 因资源不足而暂时无法派发的就绪任务, 每次就绪只发出一次resource_wait事件
+        self.resource_waiting = set()
+        # 正在运行的任务名
+        self.running = set()
+        self.cond = threading.Condition(self.__LOCK__)
         self.state = self.__init_state()
         self.task_number = len(self.state)
         self.outdir = outdir
         self.success = 0
         self.failed = 0
-        # wait resource time limit
+        # 任务因资源不足排队超过该时间后给出警告, 但不会判定其失败
         self.timeout = timeout
+        self.queued_time = dict()
+        # 状态变化先追加到日志, 每隔compact_interval秒才重写一次完整的状态表
+        self.journal = None
+        self.compact_interval = self.parser.getfloat('mode', 'state_compact_interval', fallback=60)
+        self.last_compact_time = 0
+        # 可选的sqlite状态存储, 适合超大流程, 可用'nestpipe status'实时查询
+        if self.parser.get('mode', 'state_backend', fallback='file') == 'sqlite':
+            self.state_db = StateDB(os.path.join(self.outdir, 'cmd_state.db'))
+            self.state_db.init_tasks(self.state)
+        else:
+            self.state_db = None
+        # 声明了inputs/outputs的任务, 输出比输入新且cmd和输入未变化时, 无需重新运行
+        if any('inputs' in self.parser[x] or 'outputs' in self.parser[x] for x in self.state):
+            self.cache = TaskCache(self.outdir, use_hash=self.parser.getboolean('mode', 'hash_inputs', fallback=False))
+        else:
+            self.cache = None
+        # 所有任务的资源采样时间序列写入logs/resource.series.bin, 可用load_resource_series读取
+        self.series = None
         if not logger:
             self.logger = set_logger(name=os.path.join(self.outdir, 'workflow.log'))
         else:
             self.logger = logger
+        # 声明了temp_outputs的任务, 其所有下游任务都成功后由后台线程删除或压缩这些中间文件
+        self.temp_outputs = {
+            x: split_paths(self.parser.get(x, 'temp_outputs')) for x in self.state if 'temp_outputs' in self.parser[x]
+        }
+        self.cleaned = set()
+        # 在parallel_run开始时建立
+        self.cleaner = None
+        # 可选的日志归档: 每次运行结束后把stdout/stderr/resource压缩追加到logs/archive.*并删除这些小文件,
+        # 可用'nestpipe logs'读取; 本机任务运行时的日志可以先写在log_spool_dir(如本地磁盘)中
+        self.archive = None
+        self.spool_dir = None
+        # 可选的HTTP状态接口, [mode]中设置status_port后在parallel_run开始时建立
+        self.status_server = None
+        # 状态变化事件追加到outdir/events.jsonl, 可用'nestpipe report'生成时间线报告
+        self.event_log = None
+        # asyncio引擎运行远程任务的线程池, 在_async_run中建立
+        self.run_pool = None
         # draw state graph
         self.draw_state_graph = draw_state_graph if pgv else False
+        if self.draw_state_graph:
+            self.renderer = StateRenderer(
+                self._snapshot_state,
+                img_file=os.path.join(self.outdir, 'state.svg'),
+                interval=self.parser.getfloat('mode', 'draw_interval', fallback=10),
+                # 任务数超过阈值时按主步骤合并节点, 可用'nestpipe graph -step xx'查看某一步骤的细节
+                collapse=self.task_number > self.parser.getint('mode', 'collapse_graph_threshold', fallback=500)
+            )
+        else:
+            self.renderer = None
+        self.depends, self.successors = self.__init_graph()
+        # 任务优先级为其到流程终点的最长路径耗时, 关键路径上的任务优先派发
+        self.priority = self.__init_priority()
+        self.pending = dict()
+        # 设置了batch的任务, 就绪后按主步骤索引, 派发时与同一主步骤的其他就绪任务合并为一次进程启动
+        self.batch = {x: self.parser.getint(x, 'batch') for x in self.state if 'batch' in self.parser[x]}
+        self.batch_ready = dict()
+        self.queue = self.__init_queue()
+        # 资源账本, 派发任务时按申报的cpu/mem预留, 放不下的任务继续排队, 让小任务先补空
+        self.requests = self.__init_requests()
+        self.ledger = ResourceLedger(
+            total_cpu=self.parser.getfloat('mode', 'total_cpu', fallback=None),
+            total_mem=self.parser.getfloat('mode', 'total_mem', fallback=None),
+            total_io=self.parser.getfloat('mode', 'io_budget', fallback=None),
+        )
+        # 每个执行节点一个资源账本, 远程worker在parallel_run开始时注册
+        # 可选的cpu绑定, 本机任务按申报的cpu数目分配互不重叠的cpu, 优先在同一个NUMA节点内
+        if self.parser.getboolean('mode', 'pin_cpu', fallback=False):
+            core_map = CoreMap()
+            self.logger.info('Pin tasks to cpu, NUMA nodes: {}'.format(core_map.nodes))
+        else:
+            core_map = None
+        self.executors = dict(local=LocalExecutor(
+            self.forkserver, core_map=core_map,
+            thread_env=self.parser.getboolean('mode', 'pin_thread_env', fallback=True)
+        ))
+        self.ledgers = dict(local=self.ledger)
+        self.assigned = dict()
+        # 多个节点共用同一项目目录时, 通过租约文件认领任务, 在parallel_run开始时建立
+        self.shared = None
+        # 被其他节点认领的任务, 租约失效时重新入队
+        self.claimed_elsewhere = dict()
+        # 正在运行的任务的Command, 批量运行时只记录leader
+        self.commands = dict()
+        # 内存压力(PSI)超过阈值时暂停派发新任务, 并挂起优先级最低的本机任务, 压力下降后再恢复
+        self.psi_threshold = self.parser.getfloat('mode', 'psi_threshold', fallback=0)
+        self.admission_paused = False
+        # 队首任务放不下时, 每次挑选最多跳过这么多个任务去找能补空的任务, 避免大队列下每次都扫描整个队列
+        self.backfill_depth = self.parser.getint('mode', 'backfill_depth', fallback=100)
+        self.suspended = list()
+
+    def __init_graph(self):
+        # 预先建立依赖和反向依赖索引, 任务结束时只需访问其直接下游
+        depends = dict()
+        successors = dict()
+        for name in self.state:
+            successors[name] = list()
+        for name in self.state:
+            depends[name] = self.get_dependency(name)
+            for each in depends[name]:
+                if each not in successors:
+                    raise Exception(f'Step "{each}" is not in your pipeline! A spelling mistake?')
+                successors[each].append(name)
+        return depends, successors
+
+    def _load_history(self):
+        # 从之前运行留下的状态表和日志中获取成功任务的耗时
+        history = dict()
+        for name, record in self._read_state().items():
+            if record['state'] != 'success':
+                continue
+            try:
+                history[name] = float(record['used_time'])
+            except ValueError:
+                pass
+        return history
+
+    def _estimate_time(self):
+        # 优先使用pipeline.ini中的est_time, 其次是历史耗时, 再次是同一主步骤的平均历史耗时
+        history = self._load_history()
+        step_time = dict()
+        for name, used_time in history.items():
+            step_time.setdefault(name.split('_', 1)[0], list()).append(used_time)
+        step_time = {k: sum(v)/len(v) for k, v in step_time.items()}
+        est_time = dict()
+        for name in self.state:
+            if 'est_time' in self.parser[name]:
+                est_time[name] = self.parser.getfloat(name, 'est_time')
+            elif name in history:
+                est_time[name] = history[name]
+            elif name.split('_', 1)[0] in step_time:
+                est_time[name] = step_time[name.split('_', 1)[0]]
+            else:
+                est_time[name] = 1.0
+        return est_time
+
+    def __init_priority(self):
+        est_time = self._estimate_time()
+        # 拓扑排序后逆序计算最长下游路径
+        in_degree = {x: len(y) for x, y in self.depends.items()}
+        order = [x for x, y in in_degree.items() if y == 0]
+        for name in order:
+            for each in self.successors[name]:
+                in_degree[each] -= 1
+                if in_degree[each] == 0:
+                    order.append(each)
+        priority = dict()
+        for name in self.state:
+            priority[name] = est_time[name]
+        for name in reversed(order):
+            downstream = [priority[x] for x in self.successors[name]]
+            if downstream:
+                priority[name] = est_time[name] + max(downstream)
+        if priority:
+            self.logger.info('Estimated critical path time: {}s'.format(round(max(priority.values()), 4)))
+        return priority
 
     def __init_queue(self):
-        cmd_pool = queue.Queue()
-        for each in self.orphans():
-            cmd_pool.put(each)
-            self.ever_queued.add(each)
+        # 根据当前状态计算每个任务尚未完成的依赖数目, 依赖数目为0的任务直接进入队列
+        cmd_pool = list()
+        self.pending = dict()
+        self.batch_ready = dict()
+        # 每有任务进入就绪队列加1, 与各节点账本的版本一起判断上次挑选失败后是否有变化
+        self.ready_version = 0
+        self.last_miss = None
+        self.success = 0
+        self.failed = 0
+        for name, depends in self.depends.items():
+            if name in self.ever_queued:
+                if self.state[name]['state'] == 'success':
+                    self.success += 1
+                continue
+            self.pending[name] = len([x for x in depends if self.state[x]['state'] != 'success'])
+            if self.pending[name] == 0:
+                heapq.heappush(cmd_pool, (-self.priority[name], name))
+                self._index_batch(name)
+                self.ever_queued.add(name)
+                self.state[name]['state'] = 'queueing'
+                self.queued_time[name] = self.ready_time[name] = time.time()
+            else:
+                self.state[name]['state'] = 'outdoor'
+        self.end = not cmd_pool
         return cmd_pool
 
+    def __init_requests(self):
+        requests = dict()
+        for name in self.state:
+            tmp_dict = self.get_cmd_description_dict(name)
+            requests[name] = (
+                float(tmp_dict['cpu']), float(tmp_dict['mem']), tmp_dict['check_resource_before_run'], tmp_dict['io']
+            )
+        return requests
+
     def __init_state(self):
         state_dict = dict()
         for name in self.names():
@@ -377,22 +1369,294 @@ class RunCommands(CommandNetwork):
             state_dict[name]['depend'] = ','.join(self.get_dependency(name))
         return state_dict
 
-    def _update_queue(self):
-        success = set(x for x in self.state if self.state[x]['state'] == 'success')
-        failed = set(x for x in self.state if self.state[x]['state'] == 'failed')
-        waiting = set(self.names()) - self.ever_queued
-        if not waiting:
-            self.queue.put(None)
-        for each in waiting:
-            dependency = set(self.get_dependency(each))
-            if dependency & failed:
+    def _update_queue(self, name):
+        # 调用前需持有self.cond, 只更新刚结束的任务的直接下游
+        if self.state[name]['state'] == 'success':
+            for each in self.successors[name]:
+                self.pending[each] -= 1
+                if self.pending[each] == 0 and each not in self.ever_queued:
+                    self.ever_queued.add(each)
+                    self.state[each]['state'] = 'queueing'
+                    heapq.heappush(self.queue, (-self.priority[each], each))
+                    self._index_batch(each)
+                    self._mark_ready(each)
+        else:
+            # 失败沿反向依赖向下游传递
+            to_fail = list(self.successors[name])
+            while to_fail:
+                each = to_fail.pop()
+                if each in self.ever_queued:
+                    continue
                 self.ever_queued.add(each)
                 self.state[each]['state'] = 'failed'
                 self.state[each]['used_time'] = 'FailedDependencies'
+                self._journal(each)
+                self.failed += 1
+                self._emit('finished', each, used_time='FailedDependencies', step=main_step(each))
                 self.logger.warning(each + ' cannot be started for some failed dependencies!')
-            if not (dependency - success):
-                self.ever_queued.add(each)
-                self.queue.put(each, block=True)
+                to_fail.extend(self.successors[each])
+        if not self.queue and not self.running and not self.claimed_elsewhere and not self.delayed:
+            self.end = True
+        # 有新任务入队或有资源被释放, 唤醒一个等待的线程, 它派发成功后再唤醒下一个; 流程结束时唤醒所有线程
+        if self.end:
+            self.cond.notify_all()
+        else:
+            self.cond.notify()
+
+    def _pick_task(self):
+        # 调用前需持有self.cond, 按优先级找到第一个放得下的任务并预留资源
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            item = heapq.heappop(self.delayed)[1]
+            heapq.heappush(self.queue, item)
+            self._mark_ready(item[1])
+        if self.admission_paused and self.running:
+            return None
+        # 上次挑选失败后既没有新的就绪任务也没有释放资源, 不必再扫描队列
+        version = (self.ready_version, tuple(x.version for x in self.ledgers.values()))
+        if version == self.last_miss:
+            return None
+        name = None
+        skipped = list()
+        # 放不下的申报组合, 同一次扫描中资源只会减少, 相同申报的任务不必再尝试
+        misfits = set()
+        while self.queue and len(skipped) < self.backfill_depth:
+            item = heapq.heappop(self.queue)
+            if self.state[item[1]]['state'] != 'queueing':
+                # 已由其他节点完成, 或已被合并到其他批次中
+                continue
+            cpu, mem, check, io = self.requests[item[1]]
+            if not self.running and check and not any(x.fits(cpu, mem, io) for x in self.ledgers.values()):
+                # 没有任何任务在运行时仍放不下, 说明申报的资源超过了节点上限, 只能单独运行
+                self.logger.warning('Declared resource of {} exceeds the node capacity, run it alone'.format(item[1]))
+            if (cpu, mem, check, io) in misfits or \
+                    not self._reserve(item[1], cpu, mem, force=not check or not self.running, io=io):
+                misfits.add((cpu, mem, check, io))
+                skipped.append(item)
+                if item[1] not in self.resource_waiting:
+                    self.resource_waiting.add(item[1])
+                    self._emit('resource_wait', item[1], cpu=cpu, mem=mem, io=io)
+                if item[1] in self.queued_time and time.time() - self.queued_time[item[1]] > self.timeout:
+                    self.queued_time.pop(item[1])
+                    self.logger.warning('Local resource is Not enough for {}, keep waiting!'.format(item[1]))
+                continue
+            if not self._claim(item):
+                continue
+            name = item[1]
+            break
+        for item in skipped:
+            heapq.heappush(self.queue, item)
+        if name is None:
+            self.last_miss = version
+        else:
+            self.queued_time.pop(name, None)
+            self.resource_waiting.discard(name)
+            self._emit('dispatched', name, node=self.assigned[name], priority=self.priority[name])
+            self.logger.info('Dispatch {} to {} with priority {}'.format(
+                name, self.assigned[name], round(self.priority[name], 4)))
+        return name
+
+    def _claim(self, item):
+        # 调用前需持有self.cond, 共享模式下认领任务, 已被其他节点认领或完成时释放预留的资源
+        name = item[1]
+        if self.shared is None:
+            return True
+        if self.shared.claim(name):
+            # 其他节点先写日志再释放租约, 认领成功后读取最新日志, 确认该任务没有刚被其他节点完成
+            self._apply_shared(self.shared.read_new())
+            if self.state[name]['state'] not in ('success', 'failed'):
+                return True
+            self.shared.release(name)
+            if name in self.assigned:
+                self.ledgers[self.assigned.pop(name)].release(name)
+            return False
+        if name in self.assigned:
+            self.ledgers[self.assigned.pop(name)].release(name)
+        self.claimed_elsewhere[name] = item
+        self.queued_time.pop(name, None)
+        self.state[name]['state'] = 'running'
+        return False
+
+    def _index_batch(self, name):
+        # 调用前需持有self.cond
+        if self.batch.get(name, 1) > 1:
+            self.batch_ready.setdefault(main_step(name), list()).append(name)
+
+    def _gather_batch(self, name):
+        # 调用前需持有self.cond, 取出与name同一主步骤的其他就绪任务, 与name合并为一批, 整批只预留name申报的资源
+        names = [name]
+        # 已从batch_ready中取出的任务, 无论是否加入本批次, 都不再留在就绪队列中
+        taken = list()
+        ready = self.batch_ready.get(main_step(name), [])
+        while len(names) < self.batch.get(name, 1) and ready:
+            each = ready.pop()
+            if each in names or self.state[each]['state'] != 'queueing' or self.batch.get(each, 1) <= 1:
+                continue
+            taken.append(each)
+            if not self._claim((-self.priority[each], each)):
+                continue
+            self.state[each]['state'] = 'running'
+            self.queued_time.pop(each, None)
+            self.running.add(each)
+            names.append(each)
+        if taken:
+            self._unqueue(taken)
+        if len(names) > 1:
+            self.logger.info('Batch {} with {}'.format(name, ','.join(names[1:])))
+        return names
+
+    def _unqueue(self, names):
+        # 调用前需持有self.cond, 从就绪队列中删除不再等待派发的任务, 队列为空才能判断流程结束
+        names = set(names)
+        self.queue[:] = [x for x in self.queue if x[1] not in names]
+        heapq.heapify(self.queue)
+
+    def _apply_shared(self, lines, initial=False):
+        # 调用前需持有self.cond, 合并其他节点的状态变化; 启动时只接受成功的记录, 之前失败的任务由本节点重新尝试
+        fields = ['state', 'used_time', 'mem', 'cpu', 'pid']
+        for line in lines:
+            line_lst = line.split('\t')
+            name = line_lst[0]
+            if len(line_lst) < len(fields) + 1 or name not in self.state or name in self.running:
+                continue
+            record = dict(zip(fields, line_lst[1:]))
+            if self.state[name]['state'] in ('success', 'failed') and name in self.ever_queued:
+                continue
+            if record['state'] == 'success' or (record['state'] == 'failed' and not initial):
+                if self.state[name]['state'] == 'queueing':
+                    self._unqueue([name])
+                self.state[name].update(record)
+                if record['state'] == 'success':
+                    self.success += 1
+                else:
+                    self.failed += 1
+                self.ever_queued.add(name)
+                self.claimed_elsewhere.pop(name, None)
+                self._update_queue(name)
+
+    def _sync_shared(self, initial=False):
+        stale = [x for x in list(self.claimed_elsewhere) if self.shared.is_stale(x)]
+        with self.cond:
+            self._apply_shared(self.shared.read_new(), initial=initial)
+            for name in stale:
+                if name in self.claimed_elsewhere:
+                    self.logger.warning('Lease of {} expired, try to claim it again'.format(name))
+                    self.state[name]['state'] = 'queueing'
+                    heapq.heappush(self.queue, self.claimed_elsewhere.pop(name))
+                    self._index_batch(name)
+                    self._mark_ready(name)
+            if not self.queue and not self.running and not self.claimed_elsewhere and not self.delayed:
+                self.end = True
+            self.cond.notify_all()
+
+    def _sync_shared_loop(self):
+        interval = self.parser.getfloat('mode', 'shared_poll_interval', fallback=2)
+        while not self.end:
+            time.sleep(interval)
+            self._sync_shared()
+
+    def _watch_pressure_loop(self):
+        # 每隔psi_interval秒读取一次内存压力, 每次最多挂起或恢复一个任务, 等待压力的变化反映到avg10上
+        interval = self.parser.getfloat('mode', 'psi_interval', fallback=2)
+        resume_threshold = self.parser.getfloat('mode', 'psi_resume_threshold', fallback=self.psi_threshold/2)
+        kind = self.parser.get('mode', 'psi_kind', fallback='some')
+        # 两次挂起之间至少间隔的秒数, 挂起后内存压力的avg10需要一段时间才会下降, 避免连续挂起过多任务
+        cooldown = self.parser.getfloat('mode', 'psi_cooldown', fallback=10)
+        last_suspend = 0
+        while not self.end:
+            time.sleep(interval)
+            pressure = read_pressure('memory')
+            if pressure is None:
+                return
+            value = pressure.get(kind, dict()).get('avg10', 0)
+            with self.cond:
+                if value >= self.psi_threshold:
+                    if not self.admission_paused:
+                        self.logger.warning('Memory pressure {} >= {}, stop dispatching new tasks'.format(
+                            value, self.psi_threshold))
+                        self.admission_paused = True
+                    if time.time() - last_suspend >= cooldown and self._suspend_task(value):
+                        last_suspend = time.time()
+                elif value < resume_threshold:
+                    if self.suspended:
+                        self._resume_task(value)
+                    elif self.admission_paused:
+                        self.logger.warning('Memory pressure {} < {}, continue dispatching'.format(
+                            value, resume_threshold))
+                        self.admission_paused = False
+                        self.cond.notify()
+
+    def _suspend_task(self, pressure):
+        # 调用前需持有self.cond, 挂起优先级最低的本机任务, 优先级相同时挂起占用内存最多的, 至少保留一个任务继续运行;
+        # 返回是否挂起了任务
+        candidates = list()
+        for name, cmd in self.commands.items():
+            if name in self.suspended or self.assigned.get(name) != 'local':
+                continue
+            if cmd.proc is None or cmd.proc.returncode is not None:
+                continue
+            candidates.append(name)
+        if len(candidates) <= 1:
+            return False
+        name = min(candidates, key=lambda x: (self.priority[x], -self.commands[x].cur_mem))
+        signal_process_group(self.commands[name].proc, signal.SIGSTOP)
+        self.suspended.append(name)
+        self.state[name]['state'] = 'suspended'
+        self._journal(name)
+        self._emit('suspended', name, pressure=pressure)
+        self._draw_state()
+        self.logger.warning('Suspend {} using {}M memory for memory pressure {}'.format(
+            name, self.commands[name].cur_mem, pressure))
+        return True
+
+    def _resume_task(self, pressure):
+        # 调用前需持有self.cond, 先恢复优先级最高的任务; 已经结束的任务不必恢复
+        self.suspended[:] = [x for x in self.suspended if x in self.commands and self.commands[x].proc is not None]
+        if not self.suspended:
+            return
+        name = max(self.suspended, key=lambda x: self.priority[x])
+        self.suspended.remove(name)
+        signal_process_group(self.commands[name].proc, signal.SIGCONT)
+        self.state[name]['state'] = 'running'
+        self._journal(name)
+        self._emit('resumed', name, pressure=pressure)
+        self._draw_state()
+        self.logger.warning('Resume {} for memory pressure {}'.format(name, pressure))
+
+    def _reserve(self, name, cpu, mem, force=False, io=0):
+        # 按顺序找到第一个放得下的节点; 强制预留时选择cpu占用比例最低的节点
+        for node, ledger in self.ledgers.items():
+            if ledger.reserve(name, cpu, mem, io=io):
+                self.assigned[name] = node
+                return node
+        if force:
+            node = min(self.ledgers, key=lambda x: self.ledgers[x].used_cpu/max(self.ledgers[x].total_cpu, 1))
+            self.ledgers[node].reserve(name, cpu, mem, force=True, io=io)
+            self.assigned[name] = node
+            return node
+        return None
+
+    def _register_workers(self):
+        # [mode]中的workers为逗号隔开的host:port, 每个地址上运行着一个'nestpipe worker'
+        workers = self.parser.get('mode', 'workers', fallback='').strip()
+        token = self.parser.get('mode', 'worker_token', fallback=None) or os.environ.get('NESTPIPE_WORKER_TOKEN')
+        for each in [x.strip() for x in workers.split(',') if x.strip()]:
+            host, port = each.rsplit(':', 1)
+            executor = RemoteExecutor(host, port, token=token)
+            if executor.name in self.executors:
+                continue
+            try:
+                hello = executor.hello()
+            except OSError as e:
+                self.logger.warning('Failed to register worker {}: {}'.format(executor.name, e))
+                continue
+            self.executors[executor.name] = executor
+            self.ledgers[executor.name] = ResourceLedger(
+                total_cpu=hello['cpu'], total_mem=hello['mem'], total_io=hello.get('io'))
+            self.logger.warning('Registered worker {} with {} cpu, {} bytes memory and io budget {}'.format(
+                executor.name, hello['cpu'], hello['mem'], hello.get('io') or 'unlimited'))
+        if len(self.ledgers) > 1 and not self.parser.getboolean('mode', 'run_local', fallback=True):
+            self.ledgers.pop('local', None)
 
     def _update_state(self, cmd=None, killed=False):
         if cmd is not None:
@@ -407,117 +1671,645 @@ class RunCommands(CommandNetwork):
                 cmd_state['mem'] = cmd.max_mem
                 cmd_state['cpu'] = cmd.max_cpu
                 cmd_state['pid'] = cmd.proc.pid
-        success = set(x for x in self.state if self.state[x]['state'] == 'success')
-        self.success = len(success)
-        failed = set(x for x in self.state if self.state[x]['state'] == 'failed')
-        self.failed = len(failed)
-        running_or_queueing = self.ever_queued - success - failed
-        waiting = set(self.names()) - self.ever_queued
+            if cmd_state['state'] == 'success':
+                self.success += 1
+            else:
+                self.failed += 1
+            return
+        # 刷新所有运行中任务的pid和状态, 开销与运行中的任务数成正比, 只在压缩状态表和退出时调用
         tmp_dict = {y: x for x, y in PROCESS_local.items()}
         tmp_dict.update({y: x for x, y in PROCESS_remote.items()})
-        for each in running_or_queueing:
+        for each in self.running:
             try:
                 if each in tmp_dict:
                     self.state[each]['pid'] = tmp_dict[each].pid
                     if tmp_dict[each].is_running():
                         if killed:
                             self.state[each]['state'] = 'killed'
-                        else:
+                        elif self.state[each]['state'] != 'suspended':
                             self.state[each]['state'] = 'running'
-                else:
-                    self.state[each]['state'] = 'queueing'
             except Exception as e:
                 pass
-        for each in waiting:
-            self.state[each]['state'] = 'outdoor'
 
-    def _write_state(self):
+    def _journal(self, name, start_time=None, end_time=None):
+        # 调用前需持有self.cond, 以追加方式记录一次状态变化并落盘, 续跑时回放
+        if self.state_db is not None:
+            self.state_db.update_task(name, self.state[name], start_time=start_time, end_time=end_time)
+        fields = ['state', 'used_time', 'mem', 'cpu', 'pid']
+        line = name + '\t' + '\t'.join([str(self.state[name][x]) for x in fields]) + '\n'
+        if self.shared is not None:
+            # 共享模式下每个节点只写自己的日志
+            self.shared.append(line)
+            return
+        if self.state_db is not None:
+            return
+        if self.journal is None:
+            self.journal = open(os.path.join(self.outdir, 'cmd_state.journal'), 'a')
+        self.journal.write(line)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def _emit(self, event, name, **fields):
+        # 调用前需持有self.cond, 把一次状态变化推送给所有监听者
+        if not self.event_listeners:
+            return
+        now = time.time()
+        # mono为单调时钟, 不受系统时间调整的影响; 补发的事件按其time换算
+        record = dict(time=now, mono=time.monotonic(), event=event, name=name, state=self.state[name]['state'])
+        record.update(fields)
+        record['mono'] -= now - record['time']
+        for listener in self.event_listeners:
+            listener(record)
+
+    def _mark_ready(self, name):
+        # 调用前需持有self.cond, 任务进入就绪队列
+        self.queued_time[name] = self.ready_time[name] = time.time()
+        self.ready_version += 1
+        self.resource_waiting.discard(name)
+        self._emit('queued', name)
+
+    def _status_snapshot(self):
+        # 供StatusServer使用: 各状态的任务数, 队列长度, 以及每个节点预留和实际使用的资源
+        with self.cond:
+            states = dict()
+            for info in self.state.values():
+                states[info['state']] = states.get(info['state'], 0) + 1
+            nodes = dict()
+            for node, ledger in self.ledgers.items():
+                nodes[node] = dict(
+                    total_cpu=ledger.total_cpu, reserved_cpu=round(ledger.used_cpu, 4), used_cpu=0,
+                    total_mem=ledger.total_mem, reserved_mem=ledger.used_mem, used_mem=0,
+                    reserved_io=ledger.used_io, running=len(ledger.reserved),
+                )
+            for name, cmd in self.commands.items():
+                node = nodes.get(self.assigned.get(name))
+                if node is not None:
+                    node['used_cpu'] = round(node['used_cpu'] + cmd.cur_cpu, 4)
+                    node['used_mem'] += int(cmd.cur_mem * 1024 * 1024)
+            return dict(
+                states=states, queue_depth=len(self.queue), delayed=len(self.delayed),
+                admission_paused=self.admission_paused, success=self.success, failed=self.failed,
+                total=self.task_number, nodes=nodes,
+            )
+
+    def _record_attempt(self, cmd, attempt, node=None):
+        # 调用前需持有self.cond, 记录每次运行的结束原因, sqlite模式下写入attempts表, 否则追加到cmd_attempts.txt
+        if cmd.proc is None:
+            return
+        # 运行区间换算到单调时钟, 批量运行时为子任务各自的起止时间
+        offset = time.monotonic() - time.time()
+        self._emit('attempt_end', cmd.name, attempt=attempt, node=node or self.assigned.get(cmd.name),
+                   exit_class=cmd.exit_class, returncode=cmd.proc.returncode, used_time=cmd.used_time,
+                   start=cmd.start_time + offset, end=cmd.end_time + offset, mem=cmd.max_mem, cpu=cmd.max_cpu)
+        if cmd.exit_class != 'success':
+            self.logger.warning('{} attempt {} failed: {} (returncode {})'.format(
+                cmd.name, attempt, cmd.exit_class, cmd.proc.returncode))
+        read_mb, write_mb = round(cmd.read_bytes/1024/1024, 4), round(cmd.write_bytes/1024/1024, 4)
+        if read_mb or write_mb:
+            self.logger.info('{} read {}M, wrote {}M, max I/O rate {}M/s'.format(
+                cmd.name, read_mb, write_mb, cmd.max_io_rate))
+        if self.state_db is not None:
+            self.state_db.add_attempt(
+                cmd.name, attempt, cmd.start_time, cmd.end_time, cmd.proc.returncode,
+                cmd.used_time, cmd.max_mem, cmd.max_cpu, cmd.proc.pid, exit_class=cmd.exit_class,
+                read_mb=read_mb, write_mb=write_mb, max_io_rate=cmd.max_io_rate
+            )
+            return
+        if self.attempt_file is None:
+            self.attempt_file = open(os.path.join(self.outdir, 'cmd_attempts.txt'), 'a')
+            if self.attempt_file.tell() == 0:
+                self.attempt_file.write('\t'.join([
+                    'name', 'attempt', 'exit_class', 'returncode', 'start_time', 'end_time',
+                    'used_time', 'mem', 'cpu', 'pid', 'mem_request', 'read', 'write', 'max_io_rate'
+                ]) + '\n')
+        self.attempt_file.write('\t'.join(str(x) for x in [
+            cmd.name, attempt, cmd.exit_class, cmd.proc.returncode, cmd.start_time, cmd.end_time,
+            cmd.used_time, cmd.max_mem, cmd.max_cpu, cmd.proc.pid, self.requests[cmd.name][1],
+            read_mb, write_mb, cmd.max_io_rate
+        ]) + '\n')
+        self.attempt_file.flush()
+
+    def _retry_later(self, cmd, tmp_dict, attempt, cache_key):
+        """
+        调用前需持有self.cond. 按任务的重试策略决定是否重试: 释放本次预留的资源后重新排队,
+        OOM时按oom_mem_factor放大内存申报, 设置了retry_backoff时等待指数增长的时间后才能重新派发
+        :return: 是否已重新排队
+        """
+        name = cmd.name
+        exit_class = cmd.exit_class
+        if exit_class in ('success', 'not_started', None) or attempt > int(tmp_dict['retry']):
+            return False
+        if exit_class not in tmp_dict['retry_on']:
+            self.logger.warning('{} will not be retried for {}'.format(name, exit_class))
+            return False
+        if exit_class == 'error' and cmd.proc.returncode in tmp_dict['no_retry_codes']:
+            self.logger.warning('{} will not be retried for deterministic exit code {}'.format(
+                name, cmd.proc.returncode))
+            return False
+        if exit_class == 'oom':
+            cpu, mem, check, io = self.requests[name]
+            # 未申报内存时以实际观察到的峰值为基数
+            new_mem = max(mem, cmd.max_mem*1024*1024) * tmp_dict['oom_mem_factor']
+            self.requests[name] = (cpu, new_mem, check, io)
+            self.logger.warning('{} was killed for out of memory, retry it with mem {}'.format(name, int(new_mem)))
+        self.running.discard(name)
+        self.commands.pop(name, None)
+        if name in self.suspended:
+            self.suspended.remove(name)
+        if name in self.assigned:
+            self.ledgers[self.assigned.pop(name)].release(name)
+        self.retrying[name] = (attempt, cache_key)
+        self.state[name]['state'] = 'queueing'
+        self._journal(name)
+        item = (-self.priority[name], name)
+        delay = min(tmp_dict['retry_backoff'] * 2 ** (attempt - 1), tmp_dict['retry_backoff_max'])
+        self._emit('retry', name, attempt=attempt, exit_class=exit_class, delay=delay)
+        if delay > 0:
+            self.logger.warning('{} will be retried after {}s'.format(name, round(delay, 4)))
+            heapq.heappush(self.delayed, (time.time() + delay, item))
+        else:
+            heapq.heappush(self.queue, item)
+            self._mark_ready(name)
+        # 释放的资源可以让其他任务派发
+        self.cond.notify()
+        return True
+
+    def _next_delay(self):
+        # 调用前需持有self.cond, 距离最早的等待重试任务可以派发还有多少秒, 没有时返回None
+        if not self.delayed:
+            return None
+        return max(self.delayed[0][0] - time.time(), 0.01)
+
+    def _write_state(self, force=False):
+        # 调用前需持有self.cond, 定期把日志压缩成完整的状态表, 先写临时文件再重命名, 保证状态表总是完整的
+        if not force and time.time() - self.last_compact_time < self.compact_interval:
+            return
+        if not force:
+            self._update_state()
+        if force and self.state_db is not None:
+            self.state_db.write_state(self.state)
         outfile = os.path.join(self.outdir, 'cmd_state.txt')
-        if time.localtime().tm_min % 5 == 0:
-            back_file = os.path.join(self.outdir, 'bak.cmd_state.txt')
-            if os.path.exists(outfile):
-                os.rename(outfile, back_file)
-        with open(outfile, 'w') as f:
+        # 共享模式下多个节点都会写状态表, 临时文件名需区分节点
+        tmp_file = '{}.{}.{}.tmp'.format(outfile, socket.gethostname(), os.getpid())
+        with open(tmp_file, 'w') as f:
             fields = ['name', 'state', 'used_time', 'mem', 'cpu', 'pid', 'depend', 'cmd']
             f.write('\t'.join(fields)+'\n')
             for name in self.state:
                 content = '\t'.join([str(self.state[name][x]) for x in fields[1:]])
                 f.write(name+'\t'+content+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, outfile)
+        if self.state_db is not None or self.shared is not None:
+            self.last_compact_time = time.time()
+            return
+        # 状态表已包含日志中的全部记录, 清空日志
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(os.path.join(self.outdir, 'cmd_state.journal'), 'w')
+        self.last_compact_time = time.time()
+
+    def _read_state(self):
+        # 读取状态表并回放其后的日志, 返回每个任务最近一次记录的状态
+        if self.state_db is not None:
+            return self.state_db.read_state()
+        return read_state_table(self.outdir)
+
+    def _snapshot_state(self):
+        with self.cond:
+            return {k: dict(v) for k, v in self.state.items()}
 
     def _draw_state(self):
-        if self.draw_state_graph:
-            outfile = os.path.join(self.outdir, 'state.svg')
-            back_file = os.path.join(self.outdir, 'bak.state.svg')
-            if os.path.exists(outfile):
-                os.rename(outfile, back_file)
-            StateGraph(self.state).draw(outfile)
+        # 只通知后台线程状态有变化, 不会阻塞任务派发
+        if self.renderer is not None:
+            self.renderer.notify()
 
     def _update_status_when_exit(self):
         # print('final update status')
         self._update_state(killed=True)
+        self._write_state(force=True)
+        if self.shared is not None:
+            # 释放被中断任务的租约, 其他节点可以立即重新认领
+            for name in list(self.shared.leases):
+                self.shared.release(name)
+        if self.renderer is not None:
+            self.renderer.stop()
+
+    def _new_command(self, name):
+        tmp_dict = self.get_cmd_description_dict(name)
+        if 'outdir' in tmp_dict:
+            tmp_dict.pop('outdir')
+        if 'logger' in tmp_dict:
+            tmp_dict.pop('logger')
+        cmd = Command(**tmp_dict, outdir=self.outdir, logger=self.logger, series=self.series,
+                      executor=self.executors[self.assigned[name]], log_dir=self._task_log_dir(name))
+        with self.cond:
+            self.commands[name] = cmd
+        return cmd, tmp_dict
+
+    def _task_log_dir(self, name):
+        # 只有本机任务使用log_spool_dir
+        if self.spool_dir is not None and self.assigned.get(name) == 'local':
+            return self.spool_dir
+        return None
+
+    def _archive_log(self, cmd, attempt, names=None):
+        # 开启日志归档时, 把本次运行的日志压缩追加到归档中, 然后删除这些日志文件; 不在调度锁内执行
+        if self.archive is None or cmd.proc is None or cmd.proc.pid is None:
+            return
+        resource_file = os.path.join(cmd._log_dir(), '{}.{}.resource.txt'.format(cmd.name, cmd.proc.pid))
+        files = [('stdout', cmd.stdout), ('stderr', cmd.stderr), ('resource', resource_file)]
+        # 远程任务的日志不在共享目录中时无法归档
+        files = [(k, v) for k, v in files if v and os.path.exists(v)]
+        try:
+            self.archive.add(names or [cmd.name], attempt, cmd.proc.pid, files, source=cmd.name)
+        except OSError as e:
+            self.logger.warning('Failed to archive log of {}: {}'.format(cmd.name, e))
+            return
+        for _, path in files:
+            os.remove(path)
+
+    def _check_up_to_date(self, name, tmp_dict):
+        if self.cache is not None and ('inputs' in tmp_dict or 'outputs' in tmp_dict):
+            up_to_date, cache_key = self.cache.is_up_to_date(
+                name, tmp_dict['cmd'], split_paths(tmp_dict.get('inputs')), split_paths(tmp_dict.get('outputs'))
+            )
+            if up_to_date:
+                self.logger.warning('{} is up to date, skip it'.format(name))
+            return up_to_date, cache_key
+        return False, None
+
+    def _start_attempt(self, name, try_times):
+        if try_times > 1:
+            self.logger.warning('{}th run {}'.format(try_times, name))
+        with self.cond:
+            now = time.time()
+            self.state[name]['state'] = 'running'
+            self._journal(name, start_time=now)
+            wait = now - self.ready_time[name] if name in self.ready_time else None
+            self._emit('started', name, attempt=try_times, node=self.assigned.get(name), wait=wait)
+            self._draw_state()
+
+    def _finish_task(self, cmd, up_to_date, cache_key):
+        # 调用前需持有self.cond
+        name = cmd.name
+        self.running.discard(name)
+        self.commands.pop(name, None)
+        self.retrying.pop(name, None)
+        if name in self.suspended:
+            self.suspended.remove(name)
+        if name in self.assigned:
+            self.ledgers[self.assigned.pop(name)].release(name)
+        if up_to_date:
+            self.state[name]['state'] = 'success'
+            self.state[name]['used_time'] = 'UpToDate'
+            self.success += 1
+        else:
+            self._update_state(cmd)
+            if self.state[name]['state'] == 'success' and self.cache is not None:
+                self.cache.update(name, cache_key)
+        self._journal(name, end_time=cmd.end_time)
+        self._emit('finished', name, used_time=self.state[name]['used_time'], exit_class=cmd.exit_class,
+                   step=main_step(name))
+        if self.shared is not None:
+            self.shared.release(name)
+        self._update_queue(name)
+        if self.state[name]['state'] == 'success':
+            self._clean_temp(name)
         self._write_state()
         self._draw_state()
 
+    def _clean_temp(self, name):
+        # 调用前需持有self.cond, name成功后检查它自己和它的直接上游, 清理所有下游都已成功的任务的temp_outputs
+        if self.cleaner is None:
+            return
+        for each in [name] + self.depends[name]:
+            if each not in self.temp_outputs or each in self.cleaned or self.state[each]['state'] != 'success':
+                continue
+            if all(self.state[x]['state'] == 'success' for x in self.successors[each]):
+                self.cleaned.add(each)
+                action = self.parser.get(each, 'temp_action', fallback=None) \
+                    or self.parser.get('mode', 'temp_action', fallback='delete')
+                self.cleaner.submit(each, self.temp_outputs[each], action)
+
     def single_run(self):
         while True:
-            if self.queue.empty():
-                time.sleep(5)
-                with self.__LOCK__:
-                    self._update_queue()
-                    self._write_state()
-                    self._draw_state()
+            with self.cond:
+                name = None
+                while not self.end:
+                    name = self._pick_task()
+                    if name is not None:
+                        break
+                    self.cond.wait(self._next_delay())
+                if name is None:
+                    break
+                self.running.add(name)
+                if self.queue:
+                    # 可能还有放得下的任务, 接力唤醒下一个等待的线程
+                    self.cond.notify()
+                names = self._gather_batch(name)
+                try_times, cache_key = self.retrying.pop(name, (0, None))
+            if len(names) > 1:
+                self._run_batch(names)
                 continue
-            name = self.queue.get(block=True)
-            if name is None:
-                self.queue.put(None)
-                self.end = True
-                break
-            tmp_dict = self.get_cmd_description_dict(name)
-            if 'outdir' in tmp_dict:
-                tmp_dict.pop('outdir')
-            if 'logger' in tmp_dict:
-                tmp_dict.pop('logger')
+            cmd, tmp_dict = self._new_command(name)
+            up_to_date = False
+            try:
+                # 每次运行一次, 失败后是否重试由_retry_later按重试策略决定
+                if try_times == 0:
+                    up_to_date, cache_key = self._check_up_to_date(name, tmp_dict)
+                if not up_to_date:
+                    try_times += 1
+                    self._start_attempt(name, try_times)
+                    cmd.run()
+                    self._archive_log(cmd, try_times)
+                    with self.cond:
+                        self._record_attempt(cmd, try_times)
+            finally:
+                with self.cond:
+                    if up_to_date or not self._retry_later(cmd, tmp_dict, try_times, cache_key):
+                        self._finish_task(cmd, up_to_date, cache_key)
+
+    def _batch_todo(self, names):
+        # 返回每个子任务的Command(只用于记录结果), 是否无需重新运行, 缓存key, 以及需要运行的子任务
+        members, up_to_date, cache_keys, todo = dict(), dict(), dict(), list()
+        for name in names:
+            members[name] = Command(self.parser[name]['cmd'], name, outdir=self.outdir, logger=self.logger)
+            up_to_date[name], cache_keys[name] = self._check_up_to_date(name, self.get_cmd_description_dict(name))
+            if not up_to_date[name]:
+                todo.append(name)
+        return members, up_to_date, cache_keys, todo
+
+    def _new_batch_command(self, leader, todo, try_times):
+        # 把todo中的子任务写成一个脚本, 由leader所在的节点一次启动, 超时时间为各子任务之和
+        descriptions = [self.get_cmd_description_dict(x) for x in todo]
+        log_dir = os.path.join(self.outdir, 'logs')
+        os.makedirs(log_dir, exist_ok=True)
+        script_file = os.path.join(log_dir, leader + '.batch.sh')
+        status_file = os.path.join(log_dir, leader + '.batch.status.txt')
+        if os.path.exists(status_file):
+            os.remove(status_file)
+        with open(script_file, 'w') as f:
+            f.write(batch_script(todo, [x['cmd'] for x in descriptions], status_file))
+        for name in todo:
+            self._start_attempt(name, try_times)
+        leader_dict = self.get_cmd_description_dict(leader)
+        cmd = Command(
+            '{} {}'.format('bash' if shutil.which('bash') else 'sh', shlex.quote(script_file)), leader + '.batch',
+            timeout=sum(int(x['timeout']) for x in descriptions), outdir=self.outdir,
+            monitor_resource=leader_dict['monitor_resource'], monitor_time_step=leader_dict['monitor_time_step'],
+            log_max_size=leader_dict['log_max_size'], logger=self.logger, series=self.series,
+            executor=self.executors[self.assigned[leader]], cpu=leader_dict['cpu'],
+            log_dir=self._task_log_dir(leader)
+        )
+        with self.cond:
+            self.commands[leader] = cmd
+        return cmd, status_file
+
+    def _collect_batch(self, cmd, todo, status_file, members, try_times):
+        # 从status_file读取每个子任务的退出码和耗时, 被中断而没有记录的子任务视为失败, 返回需要重试的子任务
+        records = dict()
+        if os.path.exists(status_file):
+            with open(status_file) as f:
+                for line in f:
+                    line_lst = line.rstrip('\n').split('\t')
+                    if len(line_lst) == 4:
+                        records[line_lst[0]] = line_lst[1:]
+        failed = list()
+        for name in todo:
+            member = members[name]
+            returncode, start_time, end_time = records.get(name, (-1, cmd.start_time, cmd.end_time))
+            # 某些locale下EPOCHREALTIME的小数点是逗号
+            member.start_time = float(str(start_time).replace(',', '.'))
+            member.end_time = float(str(end_time).replace(',', '.'))
+            member.used_time = round(member.end_time - member.start_time, 4)
+            member.max_mem = cmd.max_mem
+            member.max_cpu = cmd.max_cpu
+            member.read_bytes = cmd.read_bytes
+            member.write_bytes = cmd.write_bytes
+            member.max_io_rate = cmd.max_io_rate
+            member.stdout, member.stderr = cmd.stdout, cmd.stderr
+            member.proc = BatchProcess(cmd.proc.pid, int(returncode)) if cmd.proc is not None else None
+            member.timed_out = cmd.timed_out and name not in records
+            member.exit_class = member.classify_exit()
+            with self.cond:
+                self._record_attempt(member, try_times, node=cmd.executor.name)
+            if member.proc is None or member.proc.returncode != 0:
+                failed.append(name)
+        return failed
+
+    def _finish_batch(self, names, members, up_to_date, cache_keys):
+        # 调用前需持有self.cond, leader最后结束, 以便最后释放整批预留的资源
+        for name in names[1:] + names[:1]:
+            self._finish_task(members[name], up_to_date.get(name, False), cache_keys.get(name))
+
+    def _run_batch(self, names):
+        members, up_to_date, cache_keys = {x: Command('', x, logger=self.logger) for x in names}, dict(), dict()
+        try:
+            members, up_to_date, cache_keys, todo = self._batch_todo(names)
             try_times = 0
-            cmd = Command(**tmp_dict, outdir=self.outdir, logger=self.logger)
-            while try_times <= int(tmp_dict['retry']):
+            while todo and try_times <= int(self.get_cmd_description_dict(names[0])['retry']):
                 try_times += 1
-                enough = True
-                if tmp_dict['check_resource_before_run']:
-                    if not CheckResource().is_enough(tmp_dict['cpu'], tmp_dict['mem'], self.timeout):
-                        self.logger.warning('Local resource is Not enough for {}!'.format(cmd.name))
-                        enough = False
-                if enough:
-                    if try_times > 1:
-                        self.logger.warning('{}th run {}'.format(try_times, cmd.name))
-                    self.state[cmd.name]['state'] = 'running'
-                    with self.__LOCK__:
-                        self._draw_state()
-                    cmd.run()
-                    if cmd.proc.returncode == 0:
+                cmd, status_file = self._new_batch_command(names[0], todo, try_times)
+                cmd.run()
+                self._archive_log(cmd, try_times, names=todo)
+                todo = self._collect_batch(cmd, todo, status_file, members, try_times)
+        finally:
+            with self.cond:
+                self._finish_batch(names, members, up_to_date, cache_keys)
+
+    async def _async_run_batch(self, names):
+        loop = asyncio.get_running_loop()
+        members, up_to_date, cache_keys = {x: Command('', x, logger=self.logger) for x in names}, dict(), dict()
+        try:
+            members, up_to_date, cache_keys, todo = await loop.run_in_executor(None, self._batch_todo, names)
+            try_times = 0
+            while todo and try_times <= int(self.get_cmd_description_dict(names[0])['retry']):
+                try_times += 1
+                cmd, status_file = self._new_batch_command(names[0], todo, try_times)
+                await cmd.run_async(self.run_pool)
+                await loop.run_in_executor(None, self._archive_log, cmd, try_times, todo)
+                todo = self._collect_batch(cmd, todo, status_file, members, try_times)
+        finally:
+            with self.cond:
+                self._finish_batch(names, members, up_to_date, cache_keys)
+
+    async def _async_single_run(self, name):
+        # 与single_run中的单个任务相同, 文件检查等阻塞操作放到线程池中
+        loop = asyncio.get_running_loop()
+        with self.cond:
+            try_times, cache_key = self.retrying.pop(name, (0, None))
+        cmd, tmp_dict = self._new_command(name)
+        up_to_date = False
+        try:
+            if try_times == 0:
+                up_to_date, cache_key = await loop.run_in_executor(None, self._check_up_to_date, name, tmp_dict)
+            if not up_to_date:
+                try_times += 1
+                self._start_attempt(name, try_times)
+                await cmd.run_async(self.run_pool)
+                await loop.run_in_executor(None, self._archive_log, cmd, try_times)
+                with self.cond:
+                    self._record_attempt(cmd, try_times)
+        finally:
+            with self.cond:
+                if up_to_date or not self._retry_later(cmd, tmp_dict, try_times, cache_key):
+                    self._finish_task(cmd, up_to_date, cache_key)
+
+    async def _async_run(self, pool_size):
+        """
+        asyncio引擎: 一个事件循环完成任务派发、超时控制和日志读取, 同时运行的任务不再各自占用线程,
+        适合大量并发的短任务; 最多同时运行pool_size个任务
+        """
+        # 远程任务在线程中等待worker回传, 使用专门的线程池, 大小与最大并行任务数相同, 不与文件检查等操作争用默认线程池
+        self.run_pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='nestpipe.run')
+        # 本机任务不再各自占用一个等待退出的线程
+        watcher = pidfd_child_watcher()
+        if watcher is not None:
+            watcher.attach_loop(asyncio.get_running_loop())
+            asyncio.set_child_watcher(watcher)
+        try:
+            await self._async_loop(pool_size)
+        finally:
+            self.run_pool.shutdown(wait=False)
+            self.run_pool = None
+            if watcher is not None:
+                # 关闭并恢复默认的watcher
+                asyncio.set_child_watcher(None)
+
+    async def _async_loop(self, pool_size):
+        tasks = set()
+        # 共享模式下其他节点完成的任务会在同步线程中让新任务入队, 内存压力下降后会恢复派发, 都需要定期检查
+        poll = None
+        if self.shared is not None:
+            poll = self.parser.getfloat('mode', 'shared_poll_interval', fallback=2)
+        elif self.psi_threshold > 0:
+            poll = self.parser.getfloat('mode', 'psi_interval', fallback=2)
+        while True:
+            with self.cond:
+                while len(tasks) < pool_size and not self.end:
+                    name = self._pick_task()
+                    if name is None:
                         break
-            with self.__LOCK__:
-                self._update_state(cmd)
-                self._update_queue()
-                self._write_state()
-                self._draw_state()
+                    self.running.add(name)
+                    names = self._gather_batch(name)
+                    if len(names) > 1:
+                        tasks.add(asyncio.ensure_future(self._async_run_batch(names)))
+                    else:
+                        tasks.add(asyncio.ensure_future(self._async_single_run(name)))
+                if self.end and not tasks:
+                    break
+                # 有等待重试的任务时, 到期后需要派发
+                delay = self._next_delay()
+            timeout = min(x for x in (poll, delay) if x is not None) if (poll or delay) else None
+            if not tasks:
+                await asyncio.sleep(timeout or 1)
+                continue
+            done, tasks = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    self.logger.warning('Unexpected error: {}'.format(task.exception()))
 
     def parallel_run(self):
         atexit.register(self._update_status_when_exit)
         pool_size = self.parser.getint('mode', 'threads')
-        threads = list()
-        for _ in range(pool_size):
-            thread = threading.Thread(target=self.single_run, daemon=True)
-            threads.append(thread)
-            thread.start()
-
-        # update state
-        time.sleep(2)
-        with self.__LOCK__:
-            self._update_state()
-            self._write_state()
+        self._register_workers()
+        if self.series is None and self.parser.getboolean('mode', 'resource_series', fallback=True):
+            os.makedirs(os.path.join(self.outdir, 'logs'), exist_ok=True)
+            self.series = ResourceSeries(os.path.join(self.outdir, 'logs', 'resource.series'))
+        if self.shared is None and self.parser.getboolean('mode', 'shared', fallback=False):
+            self.shared = SharedWorkspace(
+                self.outdir, lease_timeout=self.parser.getfloat('mode', 'lease_timeout', fallback=60)
+            )
+            self.logger.warning('Running in shared mode as node {}'.format(self.shared.node))
+            self._sync_shared(initial=True)
+            self.shared.start()
+            threading.Thread(target=self._sync_shared_loop, daemon=True).start()
+        if self.psi_threshold > 0:
+            if pressure_available('memory'):
+                threading.Thread(target=self._watch_pressure_loop, daemon=True).start()
+            else:
+                self.logger.warning('/proc/pressure/memory is not available, psi_threshold is ignored')
+        if self.temp_outputs:
+            self.cleaner = TempCleaner(self.outdir, self.logger)
+        status_port = self.parser.get('mode', 'status_port', fallback='').strip()
+        if status_port:
+            self.status_server = StatusServer(
+                self._status_snapshot, host=self.parser.get('mode', 'status_host', fallback='127.0.0.1'),
+                port=int(status_port)
+            )
+            self.event_listeners.append(self.status_server.publish)
+            self.status_server.start()
+            self.logger.warning('Status server is listening on {}'.format(self.status_server.address))
+            with open(os.path.join(self.outdir, 'status_url.txt'), 'w') as f:
+                f.write(self.status_server.address + '\n')
+        if self.parser.getboolean('mode', 'event_log', fallback=True):
+            self.event_log = EventLog(os.path.join(self.outdir, 'events.jsonl'))
+            self.event_listeners.append(self.event_log.write)
+            self.event_log.write(dict(
+                time=time.time(), mono=time.monotonic(), event='run_start', node=socket.gethostname(),
+                pid=os.getpid(), tasks=self.task_number, threads=pool_size, nodes=sorted(self.ledgers),
+            ))
+        with self.cond:
+            # 已经就绪的任务
+            for name in self.state:
+                if self.state[name]['state'] == 'queueing' and name in self.ready_time:
+                    self._emit('queued', name, time=self.ready_time[name])
+        if self.parser.getboolean('mode', 'log_archive', fallback=False):
+            self.archive = LogArchive(
+                os.path.join(self.outdir, 'logs'), node=self.shared.node if self.shared is not None else None
+            )
+            spool_dir = self.parser.get('mode', 'log_spool_dir', fallback=None)
+            if spool_dir:
+                os.makedirs(spool_dir, exist_ok=True)
+                self.spool_dir = tempfile.mkdtemp(prefix='nestpipe.', dir=spool_dir)
+        with self.cond:
+            self._write_state(force=True)
             self._draw_state()
-        # join threads
-        _ = [x.join() for x in threads]
+            # 续跑时, 之前已经成功的任务也可能满足清理条件
+            for name in list(self.temp_outputs):
+                self._clean_temp(name)
+        if self.renderer is not None:
+            self.renderer.start()
+        if self.parser.get('mode', 'engine', fallback='thread') == 'asyncio':
+            asyncio.run(self._async_run(pool_size))
+        else:
+            threads = list()
+            for _ in range(pool_size):
+                thread = threading.Thread(target=self.single_run, daemon=True)
+                threads.append(thread)
+                thread.start()
+            # join threads
+            _ = [x.join() for x in threads]
+        with self.cond:
+            self._write_state(force=True)
+        if self.cleaner is not None:
+            self.cleaner.close()
+            self.cleaner = None
+        if self.event_log is not None:
+            self.event_listeners.remove(self.event_log.write)
+            self.event_log.write(dict(
+                time=time.time(), mono=time.monotonic(), event='run_end', success=self.success, failed=self.failed
+            ))
+            self.event_log.close()
+            self.event_log = None
+        if self.status_server is not None:
+            self.event_listeners.remove(self.status_server.publish)
+            self.status_server.stop()
+            self.status_server = None
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+            if self.spool_dir is not None:
+                # 被中断的任务可能留下未归档的日志
+                shutil.rmtree(self.spool_dir, ignore_errors=True)
+                self.spool_dir = None
+        if self.shared is not None:
+            self.shared.stop()
+        if self.forkserver is not None:
+            self.forkserver.close()
+        if self.renderer is not None:
+            self.renderer.stop()
         self.logger.warning('Finished all tasks!')
         self.logger.warning('Success/Total = {}/{}'.format(self.success, self.task_number))
         return self.success, len(self.state)
@@ -529,31 +2321,26 @@ class RunCommands(CommandNetwork):
                 detail_steps += [x for x in self.names() if x == each or x.startswith(each + '_')]
 
         self.ever_queued = set()
-        # 使用已有状态信息更新状态
+        # 使用已有状态信息更新状态, 状态表之后的日志记录会被回放, 因此崩溃后也能从中断处续跑
         existed_state_file = os.path.join(self.outdir, 'cmd_state.txt')
         if not os.path.exists(existed_state_file):
             raise Exception('We found no cmd_state.txt file in {}!'.format(self.outdir))
-        with open(existed_state_file, 'r') as f:
-            _ = f.readline()
-            for line in f:
-                line_lst = line.strip().split('\t')
-                fields = ['state', 'used_time', 'mem', 'cpu', 'pid', 'depend', 'cmd']
-                if line_lst[1] == 'success':
-                    if line_lst[0] in detail_steps:
-                        continue
-                    self.ever_queued.add(line_lst[0])
-                    # 已有的depend和cmd信息不被带入到continue运行模式, 给续跑功能带来更多可能
-                    if line_lst[0] in self.state:
-                        self.state[line_lst[0]].update(dict(zip(fields[:-2], line_lst[1:])))
-                    else:
-                        self.logger.warning(line_lst[0] + ' was skipped for a modified pipeline.ini was used')
+        for name, record in self._read_state().items():
+            if record['state'] == 'success':
+                if name in detail_steps:
+                    continue
+                self.ever_queued.add(name)
+                # 已有的depend和cmd信息不被带入到continue运行模式, 给续跑功能带来更多可能
+                if name in self.state:
+                    self.state[name].update({x: record[x] for x in ['state', 'used_time', 'mem', 'cpu', 'pid']})
+                else:
+                    self.logger.warning(name + ' was skipped for a modified pipeline.ini was used')
         failed = set(self.names()) - self.ever_queued
         if failed:
             self.logger.warning('Continue to run: {}'.format(failed))
         else:
             self.logger.warning('Nothing to continue run')
-        self.queue = queue.Queue()
-        self._update_queue()
+        self.queue = self.__init_queue()
         self._draw_state()
         self.parallel_run()
 
@@ -564,7 +2351,7 @@ if __name__ == '__main__':
     parser.add_argument('-cfg', required=True, help="pipeline configuration file")
     parser.add_argument('-outdir', required=False, default='.', help="output directory")
     parser.add_argument('-wt', required=False, type=float, default=10,
-                        help="time to wait for enough resource to initiate a task")
+                        help="time to wait for enough resource before warning, the task keeps queueing")
     parser.add_argument('--plot', action='store_true', default=False,
                         help="if set, running state will be visualized if pygraphviz installed")
     parser.add_argument('--rerun', action='store_true', default=False,
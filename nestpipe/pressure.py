@@ -0,0 +1,40 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+
+PRESSURE_DIR = '/proc/pressure'
+
+
+def pressure_available(resource='memory'):
+    return os.path.exists(os.path.join(PRESSURE_DIR, resource))
+
+
+def read_pressure(resource='memory'):
+    """
+    读取Linux PSI(pressure stall information), 如/proc/pressure/memory:
+        some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+        full avg10=0.00 avg60=0.00 avg300=0.00 total=0
+    :return: dict, 如 {'some': {'avg10': 0.0, ...}, 'full': {...}}, 内核不支持时返回None
+    """
+    try:
+        with open(os.path.join(PRESSURE_DIR, resource)) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    result = dict()
+    for line in lines:
+        kind, *fields = line.split()
+        result[kind] = {k: float(v) for k, v in (x.split('=') for x in fields)}
+    return result
+
+
+def read_oom_kills():
+    """系统启动以来OOM killer结束进程的次数(/proc/vmstat中的oom_kill), 内核不支持时返回None"""
+    try:
+        with open('/proc/vmstat') as f:
+            for line in f:
+                if line.startswith('oom_kill '):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
@@ -0,0 +1,87 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import struct
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 每条采样记录定长56字节, 小端, 与DTYPE一一对应
+RECORD = struct.Struct('<IIdfQQQQI')
+FIELDS = ['task', 'pid', 'time', 'cpu', 'rss', 'uss', 'read_bytes', 'write_bytes', 'threads']
+DTYPE = [
+    ('task', '<u4'), ('pid', '<u4'), ('time', '<f8'), ('cpu', '<f4'), ('rss', '<u8'),
+    ('uss', '<u8'), ('read_bytes', '<u8'), ('write_bytes', '<u8'), ('threads', '<u4')
+]
+
+
+class ResourceSeries(object):
+    """
+    把所有任务的资源采样以定长二进制记录追加到同一个文件中:
+    prefix.bin保存采样记录, prefix.tasks保存任务编号与任务名的对应关系
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.task_ids = dict()
+        # 续跑时沿用已有的任务编号
+        if os.path.exists(prefix + '.tasks'):
+            with open(prefix + '.tasks') as f:
+                for line in f:
+                    task_id, name = line.rstrip('\n').split('\t', 1)
+                    self.task_ids[name] = int(task_id)
+        self.task_file = open(prefix + '.tasks', 'a')
+        self.data_file = open(prefix + '.bin', 'ab')
+
+    def task_id(self, name):
+        with self.lock:
+            if name not in self.task_ids:
+                self.task_ids[name] = len(self.task_ids)
+                self.task_file.write('{}\t{}\n'.format(self.task_ids[name], name))
+                self.task_file.flush()
+            return self.task_ids[name]
+
+    def write(self, name, pid, timestamp, cpu, rss, uss, read_bytes, write_bytes, threads):
+        task_id = self.task_id(name)
+        record = RECORD.pack(task_id, pid, timestamp, cpu, rss, uss, read_bytes, write_bytes, threads)
+        with self.lock:
+            self.data_file.write(record)
+            self.data_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.task_file.close()
+            self.data_file.close()
+
+
+def load_resource_series(prefix, names=None):
+    """
+    读取ResourceSeries写入的采样记录
+    :param prefix: 文件前缀, 如 outdir/logs/resource.series
+    :param names: 只返回这些任务的记录, 默认返回所有任务
+    :return: dict, {task_name: {'pid': array, 'time': array, 'cpu': array, 'rss': array, ...}}
+    """
+    if np is None:
+        raise Exception('numpy is needed to load resource series!')
+    task_names = dict()
+    with open(prefix + '.tasks') as f:
+        for line in f:
+            task_id, name = line.rstrip('\n').split('\t', 1)
+            task_names[int(task_id)] = name
+    with open(prefix + '.bin', 'rb') as f:
+        data = f.read()
+    # 进程异常退出时最后一条记录可能不完整
+    data = np.frombuffer(data[:len(data) - len(data) % RECORD.size], dtype=np.dtype(DTYPE))
+    order = np.argsort(data['task'], kind='stable')
+    data = data[order]
+    task_ids, starts = np.unique(data['task'], return_index=True)
+    result = dict()
+    for task_id, records in zip(task_ids, np.split(data, starts[1:])):
+        name = task_names.get(int(task_id), str(task_id))
+        if names is not None and name not in names:
+            continue
+        result[name] = {x: records[x].copy() for x in FIELDS[1:]}
+    return result
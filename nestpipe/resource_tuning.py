@@ -0,0 +1,147 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import math
+import shlex
+from nestpipe.state_db import StateDB, main_step
+from nestpipe.nestpipe import read_state_table
+
+# 这些解释器后面的第一个参数(脚本)才是真正的工具
+INTERPRETERS = {'python', 'python2', 'python3', 'Rscript', 'perl', 'bash', 'sh', 'java', 'env', 'time', 'nohup'}
+# 这些shell内置命令只是准备环境, 连同其参数一起跳过
+SETUP_COMMANDS = {'cd', 'export', 'set', 'unset', 'source', '.', 'ulimit', 'umask'}
+# 命令分隔符, 之后重新开始寻找工具
+SEPARATORS = {'&&', '||', ';', '|', '&', '(', ')'}
+
+
+def command_tool(cmd):
+    """
+    命令行使用的工具名, 如 'python /path/run.py -i x' 为 run.py, 'samtools sort ...' 为 samtools,
+    'cd /data && samtools sort ...' 也为samtools
+    """
+    lexer = shlex.shlex(cmd, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        argv = list(lexer)
+    except ValueError:
+        argv = cmd.split()
+    skip = False
+    for arg in argv:
+        if arg in SEPARATORS:
+            skip = False
+            continue
+        if skip:
+            continue
+        if arg in SETUP_COMMANDS:
+            skip = True
+            continue
+        if '=' in arg and not arg.startswith('-'):
+            # 变量赋值前缀
+            continue
+        if arg.startswith('-'):
+            continue
+        tool = os.path.basename(arg)
+        if tool not in INTERPRETERS:
+            return tool
+    return ''
+
+
+def quantile(values, q):
+    """最近秩法求分位数"""
+    values = sorted(values)
+    rank = max(int(math.ceil(q * len(values))), 1)
+    return values[rank - 1]
+
+
+def read_usage(outdir):
+    """
+    读取以往项目中成功任务实测的资源消耗
+    :return: list, 元素为(name, cmd, used_time秒, mem MB, cpu)
+    """
+    db_file = os.path.join(outdir, 'cmd_state.db')
+    if os.path.exists(db_file):
+        db = StateDB(db_file, readonly=True)
+        rows = [(x[0], x[8], x[2], x[3], x[4]) for x in db.query(state='success')]
+        db.close()
+    else:
+        state = read_state_table(outdir)
+        rows = [(k, v.get('cmd', ''), v['used_time'], v['mem'], v['cpu'])
+                for k, v in state.items() if v['state'] == 'success']
+    usage = list()
+    for name, cmd, used_time, mem, cpu in rows:
+        try:
+            used_time, mem, cpu = float(used_time), float(mem), float(cpu)
+        except (TypeError, ValueError):
+            continue
+        if mem <= 0 and cpu <= 0:
+            # 没有监控资源的任务
+            continue
+        usage.append((name, cmd or '', used_time, mem, cpu))
+    return usage
+
+
+class ResourceTuner(object):
+    """
+    根据以往项目实测的峰值cpu/mem/耗时估计任务的资源申报: 按(主步骤名, 工具)汇总,
+    找不到同名步骤时按工具汇总; 申报值取分位数乘以余量, 估计偏小导致OOM时由重试策略放大内存
+    """
+    def __init__(self, project_dirs, quantile=0.95, headroom=1.2, min_samples=3, min_mem=64):
+        """
+        :param quantile: 取实测值的分位数
+        :param headroom: 分位数之上的余量倍数
+        :param min_samples: 样本数少于此值时不估计
+        :param min_mem: 内存申报的下限, 单位MB
+        """
+        self.quantile = quantile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.min_mem = min_mem
+        self.usage = dict()
+        for outdir in project_dirs:
+            for name, cmd, used_time, mem, cpu in read_usage(outdir):
+                tool = command_tool(cmd)
+                for key in [(main_step(name), tool), ('*', tool)]:
+                    self.usage.setdefault(key, list()).append((used_time, mem, cpu))
+
+    def suggest(self, name, cmd):
+        """
+        :return: dict(cpu=, mem=字节, time=秒, samples=), 样本不足时返回None
+        """
+        tool = command_tool(cmd)
+        for key in [(main_step(name), tool), ('*', tool)]:
+            samples = self.usage.get(key, [])
+            if len(samples) >= self.min_samples:
+                break
+        else:
+            return None
+        used_time, mem, cpu = (quantile(x, self.quantile) for x in zip(*samples))
+        # cpu按0.5向上取整, 内存按64MB向上取整
+        cpu = max(math.ceil(cpu * self.headroom * 2) / 2, 0.5)
+        mem = max(int(math.ceil(mem * self.headroom / 64) * 64), self.min_mem)
+        return dict(cpu=cpu, mem=mem * 1024 * 1024, time=round(used_time, 2), samples=len(samples))
+
+    def tune(self, config, apply=False):
+        """
+        给pipeline.ini中的每个任务写入建议值suggest_cpu/suggest_mem/suggest_time;
+        apply为True时直接改写cpu和mem, 原来的申报值保存在orig_cpu/orig_mem中
+        :param config: pipeline.ini对应的ConfigParser
+        :return: dict, {任务名: 建议值}
+        """
+        result = dict()
+        for name in config.sections():
+            if name == 'mode' or 'cmd' not in config[name]:
+                continue
+            suggestion = self.suggest(name, config.get(name, 'cmd', raw=True))
+            if suggestion is None:
+                continue
+            result[name] = suggestion
+            section = config[name]
+            if apply:
+                for key in ['cpu', 'mem']:
+                    if key in section and 'orig_' + key not in section:
+                        section['orig_' + key] = config.get(name, key, raw=True)
+                    section[key] = str(suggestion[key])
+            else:
+                for key in ['cpu', 'mem', 'time']:
+                    section['suggest_' + key] = str(suggestion[key])
+        return result
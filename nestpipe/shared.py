@@ -0,0 +1,145 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import time
+import socket
+import threading
+
+
+class SharedWorkspace(object):
+    """
+    多个节点共用同一个项目目录(如NFS)时的协作机制, 不需要中心服务:
+    1. 任务开始前在 shared/leases 下以O_EXCL方式创建租约文件来认领任务, 认领成功的节点才运行该任务;
+    2. 持有租约的节点定期更新租约文件的修改时间作为心跳, 超过lease_timeout秒未更新的租约被视为失效,
+       其他节点可以重新认领;
+    3. 每个节点只向自己的 shared/journals/<node>.journal 追加状态变化, 同时读取其他节点日志的新增部分,
+       从而合并得到整个流程的状态
+    """
+    def __init__(self, outdir, node=None, lease_timeout=60):
+        self.node = node or '{}.{}'.format(socket.gethostname(), os.getpid())
+        self.lease_timeout = lease_timeout
+        self.lease_dir = os.path.join(outdir, 'shared', 'leases')
+        self.journal_dir = os.path.join(outdir, 'shared', 'journals')
+        os.makedirs(self.lease_dir, exist_ok=True)
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.journal = open(os.path.join(self.journal_dir, self.node + '.journal'), 'a')
+        # 本节点持有的租约
+        self.leases = set()
+        # 其他节点日志已读取到的位置
+        self.offsets = dict()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _lease_file(self, name):
+        return os.path.join(self.lease_dir, name)
+
+    def claim(self, name):
+        if name in self.leases:
+            # 本节点重试自己持有的任务
+            return True
+        try:
+            fd = os.open(self._lease_file(name), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self.is_stale(name) or not self._break_lease(name):
+                return False
+            try:
+                fd = os.open(self._lease_file(name), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+        os.write(fd, self.node.encode('utf-8'))
+        os.close(fd)
+        with self.lock:
+            self.leases.add(name)
+        return True
+
+    def owner(self, name):
+        try:
+            with open(self._lease_file(name)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def is_stale(self, name):
+        try:
+            return time.time() - os.stat(self._lease_file(name)).st_mtime > self.lease_timeout
+        except FileNotFoundError:
+            return True
+
+    def _break_lease(self, name):
+        # 先把失效租约重命名, 只有一个节点能重命名成功, 避免误删其他节点刚创建的新租约
+        stale_file = '{}.stale.{}'.format(self._lease_file(name), self.node)
+        try:
+            os.rename(self._lease_file(name), stale_file)
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+        # 判断失效与重命名之间, 其他节点可能已打破旧租约并创建了新租约, 重命名到的是新租约时还给它
+        try:
+            fresh = time.time() - os.stat(stale_file).st_mtime <= self.lease_timeout
+        except FileNotFoundError:
+            return False
+        if fresh:
+            try:
+                os.rename(stale_file, self._lease_file(name))
+            except OSError:
+                pass
+            return False
+        os.remove(stale_file)
+        return True
+
+    def release(self, name):
+        with self.lock:
+            self.leases.discard(name)
+        try:
+            os.remove(self._lease_file(name))
+        except FileNotFoundError:
+            pass
+
+    def append(self, line):
+        if self.journal.closed:
+            return
+        self.journal.write(line)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def read_new(self):
+        """读取其他节点日志中新增的完整行"""
+        with self.lock:
+            return self._read_new()
+
+    def _read_new(self):
+        lines = list()
+        for each in os.listdir(self.journal_dir):
+            if not each.endswith('.journal') or each == self.node + '.journal':
+                continue
+            path = os.path.join(self.journal_dir, each)
+            offset = self.offsets.get(each, 0)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end:
+                lines.extend(data[:end].decode('utf-8').splitlines())
+                self.offsets[each] = offset + end
+        return lines
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.lease_timeout / 3):
+            with self.lock:
+                leases = list(self.leases)
+            for name in leases:
+                try:
+                    os.utime(self._lease_file(name))
+                except FileNotFoundError:
+                    pass
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._heartbeat, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.journal.close()
@@ -0,0 +1,174 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    name TEXT PRIMARY KEY,
+    step TEXT,
+    state TEXT,
+    used_time TEXT,
+    mem TEXT,
+    cpu TEXT,
+    pid TEXT,
+    depend TEXT,
+    cmd TEXT,
+    attempts INTEGER DEFAULT 0,
+    start_time REAL,
+    end_time REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_step ON tasks (step, state);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state);
+CREATE TABLE IF NOT EXISTS attempts (
+    name TEXT,
+    attempt INTEGER,
+    start_time REAL,
+    end_time REAL,
+    returncode INTEGER,
+    used_time REAL,
+    mem REAL,
+    cpu REAL,
+    pid INTEGER,
+    exit_class TEXT,
+    read_mb REAL,
+    write_mb REAL,
+    max_io_rate REAL,
+    PRIMARY KEY (name, attempt)
+);
+CREATE TABLE IF NOT EXISTS dependencies (
+    name TEXT,
+    depend TEXT,
+    PRIMARY KEY (name, depend)
+);
+CREATE INDEX IF NOT EXISTS dependencies_depend ON dependencies (depend);
+"""
+
+STATE_FIELDS = ['state', 'used_time', 'mem', 'cpu', 'pid']
+
+
+def main_step(name):
+    return name.split('_', 1)[0]
+
+
+class StateDB(object):
+    """
+    基于sqlite的状态存储, 使用WAL模式, 流程写入的同时可以被其他进程查询
+    """
+    def __init__(self, db_file, readonly=False):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        if readonly:
+            uri = 'file:{}?mode=ro'.format(os.path.abspath(db_file))
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(db_file, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(SCHEMA)
+            # 旧版本建立的数据库没有exit_class和I/O统计列
+            columns = [x[1] for x in self.conn.execute('PRAGMA table_info(attempts)')]
+            for column, column_type in [('exit_class', 'TEXT'), ('read_mb', 'REAL'), ('write_mb', 'REAL'),
+                                        ('max_io_rate', 'REAL')]:
+                if column not in columns:
+                    self.conn.execute('ALTER TABLE attempts ADD COLUMN {} {}'.format(column, column_type))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def init_tasks(self, state):
+        """写入全部任务及依赖关系, 已有记录的状态会被保留"""
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO tasks (name, step, state, used_time, mem, cpu, pid, depend, cmd) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(name, main_step(name)) + tuple(str(info[x]) for x in STATE_FIELDS) + (info['depend'], info['cmd'])
+                 for name, info in state.items()]
+            )
+            self.conn.executemany(
+                'UPDATE tasks SET depend = ?, cmd = ? WHERE name = ?',
+                [(info['depend'], info['cmd'], name) for name, info in state.items()]
+            )
+            self.conn.execute('DELETE FROM dependencies')
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO dependencies (name, depend) VALUES (?, ?)',
+                [(name, x) for name, info in state.items() for x in info['depend'].split(',') if x]
+            )
+            self.conn.commit()
+
+    def update_task(self, name, info, start_time=None, end_time=None):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE tasks SET state = ?, used_time = ?, mem = ?, cpu = ?, pid = ?, '
+                'start_time = COALESCE(?, start_time), end_time = COALESCE(?, end_time) WHERE name = ?',
+                tuple(str(info[x]) for x in STATE_FIELDS) + (start_time, end_time, name)
+            )
+            self.conn.commit()
+
+    def write_state(self, state):
+        """一次性写入全部任务的当前状态"""
+        with self.lock:
+            self.conn.executemany(
+                'UPDATE tasks SET state = ?, used_time = ?, mem = ?, cpu = ?, pid = ? WHERE name = ?',
+                [tuple(str(info[x]) for x in STATE_FIELDS) + (name,) for name, info in state.items()]
+            )
+            self.conn.commit()
+
+    def add_attempt(self, name, attempt, start_time, end_time, returncode, used_time, mem, cpu, pid,
+                    exit_class=None, read_mb=None, write_mb=None, max_io_rate=None):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO attempts '
+                '(name, attempt, start_time, end_time, returncode, used_time, mem, cpu, pid, exit_class, '
+                'read_mb, write_mb, max_io_rate) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, attempt, start_time, end_time, returncode, used_time, mem, cpu, pid, exit_class,
+                 read_mb, write_mb, max_io_rate)
+            )
+            self.conn.execute('UPDATE tasks SET attempts = ? WHERE name = ?', (attempt, name))
+            self.conn.commit()
+
+    def read_state(self):
+        """返回每个任务最近一次记录的状态, 与RunCommands._read_state的格式一致"""
+        with self.lock:
+            rows = self.conn.execute('SELECT name, state, used_time, mem, cpu, pid FROM tasks').fetchall()
+        return {x[0]: dict(zip(STATE_FIELDS, x[1:])) for x in rows}
+
+    def summary(self, step=None):
+        """按主步骤统计各状态的任务数"""
+        sql = 'SELECT step, state, COUNT(*) FROM tasks'
+        args = tuple()
+        if step:
+            sql += ' WHERE step = ?'
+            args = (step,)
+        sql += ' GROUP BY step, state ORDER BY step'
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def query(self, step=None, state=None, name=None, limit=None):
+        sql = 'SELECT name, state, used_time, mem, cpu, pid, attempts, depend, cmd FROM tasks'
+        conditions = list()
+        args = list()
+        if step:
+            conditions.append('step = ?')
+            args.append(step)
+        if state:
+            conditions.append('state = ?')
+            args.append(state)
+        if name:
+            conditions.append('name = ?')
+            args.append(name)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        if limit:
+            sql += ' LIMIT {}'.format(int(limit))
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def attempts(self, name):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT * FROM attempts WHERE name = ? ORDER BY attempt', (name,)
+            ).fetchall()
@@ -0,0 +1,200 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import json
+import time
+import threading
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 派发延迟直方图的上界, 单位秒
+LATENCY_BUCKETS = [0.01, 0.1, 1, 10, 60, 600, 3600]
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        # 不在终端打印访问日志
+        pass
+
+    def _send(self, body, content_type):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        status = self.server.status
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            since = int(query.get('since', [self.headers.get('Last-Event-ID') or 0])[0])
+        except ValueError:
+            self.send_error(400, 'since and Last-Event-ID must be an integer event id')
+            return
+        if url.path == '/metrics':
+            self._send(status.metrics(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif url.path == '/status':
+            self._send(json.dumps(status.get_snapshot()), 'application/json')
+        elif url.path == '/events.json':
+            self._send(json.dumps(status.events_since(since)), 'application/json')
+        elif url.path == '/events':
+            self._stream(status, since)
+        else:
+            self.send_error(404, 'Try /metrics, /status, /events or /events.json?since=<id>')
+
+    def _stream(self, status, since):
+        # Server-Sent Events, 断线重连时浏览器通过Last-Event-ID续传
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while True:
+                events = status.wait_events(since, timeout=15)
+                if events is None:
+                    break
+                if not events:
+                    self.wfile.write(b': keepalive\n\n')
+                for event in events:
+                    since = event['id']
+                    self.wfile.write('id: {}\nevent: {}\ndata: {}\n\n'.format(
+                        event['id'], event['event'], json.dumps(event)).encode('utf-8'))
+                self.wfile.flush()
+        except OSError:
+            # 客户端断开
+            pass
+
+
+class StatusServer(object):
+    """
+    运行中流程的本地HTTP接口:
+    /metrics 为Prometheus格式的指标, /status 为JSON格式的当前状态,
+    /events 以SSE推送状态变化, /events.json?since=<id> 返回id之后的状态变化.
+    状态变化由RunCommands作为事件推送进来, 只在内存中保留最近的max_events条
+    """
+    def __init__(self, get_snapshot, host='127.0.0.1', port=0, max_events=10000):
+        """
+        :param get_snapshot: 返回当前状态的函数, 见RunCommands._status_snapshot
+        """
+        self.get_snapshot = get_snapshot
+        self.events = deque(maxlen=max_events)
+        self.next_id = 1
+        self.cond = threading.Condition()
+        self.stopped = False
+        # 由事件累计的计数器
+        self.finished = dict()
+        self.task_seconds = dict()
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0
+        self.latency_count = 0
+        self.start_time = time.time()
+        self.server = ThreadingHTTPServer((host, int(port)), StatusHandler)
+        self.server.daemon_threads = True
+        self.server.status = self
+        self.thread = None
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def publish(self, event):
+        with self.cond:
+            event = dict(event, id=self.next_id)
+            self.next_id += 1
+            self.events.append(event)
+            if event['event'] == 'started' and event.get('wait') is not None:
+                self.latency_sum += event['wait']
+                self.latency_count += 1
+                for index, bound in enumerate(LATENCY_BUCKETS):
+                    if event['wait'] <= bound:
+                        self.latency_buckets[index] += 1
+            elif event['event'] == 'finished':
+                key = (event['step'], event['state'])
+                self.finished[key] = self.finished.get(key, 0) + 1
+                if isinstance(event.get('used_time'), (int, float)):
+                    self.task_seconds[event['step']] = self.task_seconds.get(event['step'], 0) + event['used_time']
+            self.cond.notify_all()
+
+    def events_since(self, since):
+        with self.cond:
+            return [x for x in self.events if x['id'] > since]
+
+    def wait_events(self, since, timeout):
+        """返回id在since之后的事件, 没有时最多等待timeout秒; 服务停止后返回None"""
+        with self.cond:
+            if not self.stopped and (not self.events or self.events[-1]['id'] <= since):
+                self.cond.wait(timeout)
+            if self.stopped:
+                return None
+            return [x for x in self.events if x['id'] > since]
+
+    def metrics(self):
+        snapshot = self.get_snapshot()
+        lines = list()
+
+        def add(name, kind, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(k, _label(v)) for k, v in labels)
+                lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', value))
+
+        add('nestpipe_tasks', 'gauge', 'Number of tasks by state',
+            [([('state', k)], v) for k, v in sorted(snapshot['states'].items())])
+        add('nestpipe_queue_depth', 'gauge', 'Number of ready tasks waiting to be dispatched',
+            [([], snapshot['queue_depth'])])
+        add('nestpipe_delayed_tasks', 'gauge', 'Number of tasks waiting for retry backoff',
+            [([], snapshot['delayed'])])
+        add('nestpipe_admission_paused', 'gauge', '1 if dispatch is paused for memory pressure',
+            [([], int(snapshot['admission_paused']))])
+        nodes = sorted(snapshot['nodes'].items())
+        for key, kind, help_text in [
+            ('total_cpu', 'cpu_total', 'Cpu that can be reserved on the node'),
+            ('reserved_cpu', 'cpu_reserved', 'Cpu reserved by running tasks'),
+            ('used_cpu', 'cpu_used', 'Cpu used by running tasks at the last sample'),
+            ('total_mem', 'mem_total_bytes', 'Memory that can be reserved on the node'),
+            ('reserved_mem', 'mem_reserved_bytes', 'Memory reserved by running tasks'),
+            ('used_mem', 'mem_used_bytes', 'Memory used by running tasks at the last sample'),
+            ('reserved_io', 'io_reserved', 'Io weight reserved by running tasks'),
+        ]:
+            add('nestpipe_' + kind, 'gauge', help_text, [([('node', x)], y[key]) for x, y in nodes])
+        add('nestpipe_running_tasks', 'gauge', 'Number of running tasks on the node',
+            [([('node', x)], y['running']) for x, y in nodes])
+        with self.cond:
+            buckets = list(self.latency_buckets)
+            latency_sum, latency_count = self.latency_sum, self.latency_count
+            finished = sorted(self.finished.items())
+            task_seconds = sorted(self.task_seconds.items())
+        samples = [([('le', x)], y) for x, y in zip(LATENCY_BUCKETS, buckets)]
+        samples.append(([('le', '+Inf')], latency_count))
+        lines.append('# HELP nestpipe_dispatch_latency_seconds Time from a task being ready to being started')
+        lines.append('# TYPE nestpipe_dispatch_latency_seconds histogram')
+        for labels, value in samples:
+            lines.append('nestpipe_dispatch_latency_seconds_bucket{{le="{}"}} {}'.format(labels[0][1], value))
+        lines.append('nestpipe_dispatch_latency_seconds_sum {}'.format(round(latency_sum, 6)))
+        lines.append('nestpipe_dispatch_latency_seconds_count {}'.format(latency_count))
+        add('nestpipe_step_finished_total', 'counter', 'Tasks finished per main step and final state',
+            [([('step', x[0]), ('state', x[1])], y) for x, y in finished])
+        add('nestpipe_step_task_seconds_total', 'counter', 'Run time of finished tasks per main step',
+            [([('step', x)], round(y, 4)) for x, y in task_seconds])
+        add('nestpipe_uptime_seconds', 'gauge', 'Seconds since the status server started',
+            [([], round(time.time() - self.start_time, 3))])
+        return '\n'.join(lines) + '\n'
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
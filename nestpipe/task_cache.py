@@ -0,0 +1,102 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def split_paths(value):
+    """pipeline.ini中inputs/outputs的值, 多个路径用逗号隔开"""
+    if not value:
+        return []
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+
+def file_sha256(path, block_size=1024*1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class TaskCache(object):
+    """
+    类似make的更新检查: 任务的key由cmd和所有输入文件的(大小, 修改时间)或内容哈希计算得到,
+    当所有输出文件都存在且比输入文件新, 并且key与上次成功运行时记录的相同, 任务无需重新运行.
+    outdir/cmd_cache.txt 记录每个任务最近一次成功运行的key,
+    outdir/hash_index.txt 缓存文件内容哈希, 文件大小和修改时间不变时不再重新计算,
+    两个文件都只追加, 读取时以最后一条记录为准
+    """
+    def __init__(self, outdir, use_hash=False, threads=4):
+        self.use_hash = use_hash
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.cache_file = os.path.join(outdir, 'cmd_cache.txt')
+        self.index_file = os.path.join(outdir, 'hash_index.txt')
+        self.keys = self._read(self.cache_file, 2)
+        self.hashes = {k: tuple(v) for k, v in self._read(self.index_file, 4).items()}
+
+    @staticmethod
+    def _read(path, field_number):
+        records = dict()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line_lst = line.rstrip('\n').split('\t')
+                    if len(line_lst) != field_number:
+                        continue
+                    records[line_lst[0]] = line_lst[1] if field_number == 2 else line_lst[1:]
+        return records
+
+    def _append(self, path, line):
+        with self.lock:
+            with open(path, 'a') as f:
+                f.write(line)
+
+    def _file_signature(self, path):
+        stat = os.stat(path)
+        signature = (str(stat.st_size), str(stat.st_mtime_ns))
+        if not self.use_hash:
+            return ':'.join(signature)
+        with self.lock:
+            cached = self.hashes.get(path)
+        if cached and cached[:2] == signature:
+            return cached[2]
+        sha = file_sha256(path)
+        with self.lock:
+            self.hashes[path] = signature + (sha,)
+        self._append(self.index_file, '\t'.join((path,) + signature + (sha,)) + '\n')
+        return sha
+
+    def key(self, cmd, inputs):
+        # 多个输入文件的哈希并行计算
+        signatures = list(self.pool.map(self._file_signature, inputs))
+        sha = hashlib.sha256(cmd.encode('utf-8'))
+        for path, signature in zip(inputs, signatures):
+            sha.update('\t{}\t{}'.format(path, signature).encode('utf-8'))
+        return sha.hexdigest()
+
+    def is_up_to_date(self, name, cmd, inputs, outputs):
+        """
+        :return: (是否无需重新运行, 当前key), 输入文件缺失时key为None
+        """
+        if any(not os.path.exists(x) for x in inputs):
+            return False, None
+        key = self.key(cmd, inputs)
+        if not outputs or any(not os.path.exists(x) for x in outputs):
+            return False, key
+        if inputs:
+            newest_input = max(os.path.getmtime(x) for x in inputs)
+            if min(os.path.getmtime(x) for x in outputs) < newest_input:
+                return False, key
+        with self.lock:
+            return self.keys.get(name) == key, key
+
+    def update(self, name, key):
+        if key is None:
+            return
+        with self.lock:
+            self.keys[name] = key
+        self._append(self.cache_file, '{}\t{}\n'.format(name, key))
@@ -0,0 +1,80 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import glob
+import gzip
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, x)) for root, _, files in os.walk(path) for x in files)
+    return os.path.getsize(path)
+
+
+class TempCleaner(object):
+    """
+    清理中间文件: 任务的temp_outputs在其所有下游任务都成功后由后台线程删除或用gzip压缩,
+    调度线程不需要等待. 每个被清理的文件及回收的字节数追加到outdir/temp_outputs.txt
+    """
+    def __init__(self, outdir, logger=None):
+        self.logger = logger
+        self.record_file = os.path.join(outdir, 'temp_outputs.txt')
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.reclaimed = 0
+
+    def submit(self, name, paths, action='delete'):
+        """
+        :param paths: 文件或目录, 可以是通配符
+        :param action: delete或gzip, 目录只能删除
+        """
+        return self.pool.submit(self._clean, name, paths, action)
+
+    def _clean(self, name, paths, action):
+        for pattern in paths:
+            for path in sorted(glob.glob(pattern)):
+                try:
+                    reclaimed = self._clean_one(path, action)
+                except OSError as e:
+                    self.logger.warning('Failed to clean {} of {}: {}'.format(path, name, e))
+                    continue
+                if reclaimed is None:
+                    continue
+                with self.lock:
+                    self.reclaimed += reclaimed
+                    with open(self.record_file, 'a') as f:
+                        f.write('\t'.join([name, path, action, str(reclaimed), str(time.time())]) + '\n')
+                self.logger.info('Cleaned {} of {} by {}, reclaimed {} bytes'.format(path, name, action, reclaimed))
+
+    def _clean_one(self, path, action):
+        # 返回回收的字节数, 未处理时返回None
+        size = path_size(path)
+        if action == 'delete':
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            return size
+        if path.endswith('.gz'):
+            # 已经压缩过, 续跑时通配符可能匹配到
+            return None
+        if os.path.isdir(path):
+            self.logger.warning('{} is a directory and cannot be compressed, skip it'.format(path))
+            return None
+        # 先写临时文件再重命名, 中途失败时原文件仍然完整
+        tmp_file = '{}.gz.{}.tmp'.format(path, os.getpid())
+        with open(path, 'rb') as fi, gzip.open(tmp_file, 'wb', compresslevel=6) as fo:
+            shutil.copyfileobj(fi, fo, 1024*1024)
+        os.replace(tmp_file, path + '.gz')
+        os.remove(path)
+        return size - os.path.getsize(path + '.gz')
+
+    def close(self):
+        # 等待已提交的清理完成
+        self.pool.shutdown(wait=True)
+        if self.reclaimed:
+            self.logger.warning('Reclaimed {} bytes from temporary outputs'.format(self.reclaimed))
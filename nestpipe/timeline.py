@@ -0,0 +1,285 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import json
+import html
+import time
+import heapq
+import threading
+try:
+    from .state_db import main_step
+except ImportError:
+    # 被nestpipe.py以脚本方式运行时导入
+    from state_db import main_step
+
+# 主步骤的配色, 循环使用
+COLORS = [
+    '#4E79A7', '#F28E2B', '#59A14F', '#E15759', '#76B7B2', '#EDC948', '#B07AA1', '#FF9DA7', '#9C755F', '#BAB0AC'
+]
+
+
+class EventLog(object):
+    """
+    把RunCommands的状态变化事件逐行以JSON追加到outdir/events.jsonl, 每次运行流程以run_start开始、run_end结束.
+    事件中的mono为time.monotonic(), 同一次运行内不受系统时间调整影响, 用于计算等待时间和绘制时间线
+    """
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, event):
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(json.dumps(event) + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load_events(path, run=-1):
+    """
+    :param run: 第几次运行流程, 默认最后一次
+    :return: 该次运行的事件列表
+    """
+    runs = list()
+    with open(path) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # 崩溃时可能只写了半行
+                continue
+            if event['event'] == 'run_start' or not runs:
+                runs.append(list())
+            runs[-1].append(event)
+    if not runs:
+        return []
+    return runs[run]
+
+
+def collect(events):
+    """
+    :return: (attempts, tasks), attempts为每次运行的时间区间, tasks为每个任务的排队/等待资源/运行统计, 时间相对流程开始
+    """
+    origin = min(x['mono'] for x in events)
+    attempts = list()
+    tasks = dict()
+    for event in events:
+        name = event.get('name')
+        if not name:
+            continue
+        task = tasks.setdefault(name, dict(
+            name=name, step=main_step(name), queue_wait=0, resource_wait=0, run_time=0, attempts=0, state=''
+        ))
+        mono = event['mono'] - origin
+        if event['event'] == 'queued':
+            task['queued'] = mono
+        elif event['event'] == 'resource_wait':
+            task['resource_wait_start'] = mono
+        elif event['event'] == 'dispatched':
+            if 'queued' in task:
+                task['queue_wait'] += mono - task.pop('queued')
+            if 'resource_wait_start' in task:
+                task['resource_wait'] += mono - task.pop('resource_wait_start')
+        elif event['event'] == 'started' and 'queued' in task:
+            # 批量运行时同一批的其他任务没有dispatched事件
+            task['queue_wait'] += mono - task.pop('queued')
+        elif event['event'] == 'attempt_end':
+            start, end = event['start'] - origin, event['end'] - origin
+            attempts.append(dict(
+                name=name, step=task['step'], node=event.get('node') or 'local', start=start, end=end,
+                exit_class=event.get('exit_class'), attempt=event.get('attempt'),
+            ))
+            task['attempts'] += 1
+            task['run_time'] += end - start
+        elif event['event'] == 'finished':
+            task['state'] = event['state']
+    return attempts, tasks
+
+
+def assign_lanes(intervals):
+    """
+    贪心地把按开始时间排序的区间放到最少的行中, 行号即同时运行的槽位, 优先使用行号最小的空闲行.
+    占用中的行按结束时间放在堆中, 每个区间只需弹出已结束的行
+    """
+    busy = list()
+    free = list()
+    lanes = list()
+    for start, end in intervals:
+        while busy and busy[0][0] <= start:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        lane = heapq.heappop(free) if free else len(busy)
+        heapq.heappush(busy, (end, lane))
+        lanes.append(lane)
+    return lanes
+
+
+def concurrency(intervals):
+    """返回(时间, 同时存在的区间数)的阶梯序列"""
+    points = sorted([(x, 1) for x, _ in intervals] + [(y, -1) for _, y in intervals], key=lambda x: (x[0], x[1]))
+    series = [(0, 0)]
+    current = 0
+    for point, change in points:
+        current += change
+        series.append((point, current))
+    return series
+
+
+def idle_time(ready, running):
+    """有就绪区间却没有运行区间的总时长, 对两组区间的端点只扫描一次"""
+    points = sorted([(x, 0, 1) for x, _ in ready] + [(y, 0, -1) for _, y in ready] +
+                    [(x, 1, 1) for x, _ in running] + [(y, 1, -1) for _, y in running])
+    counts = [0, 0]
+    idle = 0
+    for (t, kind, change), (next_t, _, _) in zip(points, points[1:]):
+        counts[kind] += change
+        if counts[0] > 0 and counts[1] == 0:
+            idle += next_t - t
+    return idle
+
+
+def _gantt_svg(rows, bars, colors, span, width=1200, row_height=14):
+    # rows为行名列表, bars为(行号, 开始, 结束, 主步骤, 提示文字)
+    label_width = 180
+    scale = (width - label_width - 10) / max(span, 1e-6)
+    height = row_height * len(rows) + 30
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" font-size="11">'.format(width, height)]
+    for index, row in enumerate(rows):
+        y = index * row_height
+        parts.append('<text x="2" y="{}">{}</text>'.format(y + row_height - 3, html.escape(row)))
+        parts.append('<line x1="{0}" y1="{1}" x2="{2}" y2="{1}" stroke="#eee"/>'.format(label_width, y, width))
+    for row, start, end, step, tip in bars:
+        parts.append('<rect x="{:.2f}" y="{}" width="{:.2f}" height="{}" fill="{}"><title>{}</title></rect>'.format(
+            label_width + start * scale, row * row_height + 1, max((end - start) * scale, 0.5), row_height - 2,
+            colors[step], html.escape(tip)
+        ))
+    parts.append(_time_axis(label_width, row_height * len(rows), width, span, scale))
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+
+def _time_axis(x0, y, width, span, scale):
+    parts = ['<line x1="{0}" y1="{1}" x2="{2}" y2="{1}" stroke="black"/>'.format(x0, y, width)]
+    for index in range(11):
+        t = span * index / 10
+        x = x0 + t * scale
+        parts.append('<text x="{:.2f}" y="{}" text-anchor="middle">{}s</text>'.format(
+            min(x, width - 20), y + 14, round(t, 1)))
+    return '\n'.join(parts)
+
+
+def _concurrency_svg(series_list, span, width=1200, height=200):
+    # series_list为(名称, 颜色, 阶梯序列)
+    label_width = 180
+    top = max([max(y for _, y in x[2]) for x in series_list] + [1])
+    scale_x = (width - label_width - 10) / max(span, 1e-6)
+    scale_y = (height - 30) / top
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" font-size="11">'.format(width, height)]
+    for index, (name, color, series) in enumerate(series_list):
+        points = list()
+        for (t, value), (next_t, _) in zip(series, series[1:] + [(span, 0)]):
+            points.append('{:.2f},{:.2f}'.format(label_width + t * scale_x, height - 30 - value * scale_y))
+            points.append('{:.2f},{:.2f}'.format(label_width + next_t * scale_x, height - 30 - value * scale_y))
+        parts.append('<polyline fill="none" stroke="{}" points="{}"/>'.format(color, ' '.join(points)))
+        parts.append('<text x="2" y="{}" fill="{}">{}</text>'.format(14 * (index + 1), color, html.escape(name)))
+    parts.append('<text x="{}" y="10">{}</text>'.format(label_width - 20, top))
+    parts.append(_time_axis(label_width, height - 30, width, span, scale_x))
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+
+def write_report(events, out_file):
+    """根据一次运行的事件生成HTML报告: 并发度曲线, 按执行槽位和按主步骤的甘特图, 以及各主步骤的等待和耗时统计"""
+    attempts, tasks = collect(events)
+    span = max([x['end'] for x in attempts] + [max(x['mono'] for x in events) - min(x['mono'] for x in events)])
+    steps = list()
+    for each in attempts:
+        if each['step'] not in steps:
+            steps.append(each['step'])
+    colors = {x: COLORS[i % len(COLORS)] for i, x in enumerate(steps)}
+    attempts.sort(key=lambda x: x['start'])
+
+    def tip(x):
+        return '{} attempt {}: {}s, {}'.format(x['name'], x['attempt'], round(x['end'] - x['start'], 3), x['exit_class'])
+
+    # 按执行节点的槽位
+    slot_rows, slot_bars = list(), list()
+    for node in sorted(set(x['node'] for x in attempts)):
+        items = [x for x in attempts if x['node'] == node]
+        lanes = assign_lanes([(x['start'], x['end']) for x in items])
+        offset = len(slot_rows)
+        slot_rows.extend('{} #{}'.format(node, x + 1) for x in range(max(lanes) + 1))
+        slot_bars.extend((offset + lane, x['start'], x['end'], x['step'], tip(x)) for lane, x in zip(lanes, items))
+    # 按主步骤, 同一步骤中同时运行的任务放在不同的行
+    step_rows, step_bars = list(), list()
+    for step in steps:
+        items = [x for x in attempts if x['step'] == step]
+        lanes = assign_lanes([(x['start'], x['end']) for x in items])
+        offset = len(step_rows)
+        step_rows.extend(step if x == 0 else '' for x in range(max(lanes) + 1))
+        step_bars.extend((offset + lane, x['start'], x['end'], x['step'], tip(x)) for lane, x in zip(lanes, items))
+    # 就绪但尚未派发的任务数
+    origin = min(x['mono'] for x in events)
+    ready, queued_at = list(), dict()
+    for event in events:
+        if event['event'] == 'queued':
+            queued_at[event['name']] = event['mono'] - origin
+        elif event['event'] in ('dispatched', 'started') and event['name'] in queued_at:
+            ready.append((queued_at.pop(event['name']), event['mono'] - origin))
+    ready.extend((x, span) for x in queued_at.values())
+    running_series = concurrency([(x['start'], x['end']) for x in attempts])
+
+    # 各主步骤的统计, 耗时超过该步骤中位数两倍的任务视为拖后腿的任务
+    rows = list()
+    for step in steps:
+        items = [x for x in tasks.values() if x['step'] == step and x['attempts']]
+        run_times = sorted(x['run_time'] for x in items)
+        median = run_times[len(run_times) // 2]
+        stragglers = sorted([x for x in items if x['run_time'] > 2 * median and x['run_time'] - median > 1],
+                            key=lambda x: -x['run_time'])
+        rows.append([
+            step, len(items), sum(x['attempts'] for x in items), round(sum(run_times), 3), round(median, 3),
+            round(run_times[-1], 3), round(sum(x['queue_wait'] for x in items) / len(items), 3),
+            round(sum(x['resource_wait'] for x in items) / len(items), 3),
+            ', '.join('{}({}s)'.format(x['name'], round(x['run_time'], 1)) for x in stragglers[:10]),
+        ])
+    busy = sum(x['end'] - x['start'] for x in attempts)
+    # 有任务就绪却没有任务在运行的时间, 多为调度或资源等待造成的空闲
+    ready_series = concurrency(ready)
+    idle = idle_time(ready, [(x['start'], x['end']) for x in attempts])
+
+    header = ['step', 'tasks', 'attempts', 'total run time(s)', 'median(s)', 'max(s)', 'mean queue wait(s)',
+              'mean resource wait(s)', 'stragglers']
+    table = ['<table border="1" cellspacing="0" cellpadding="3"><tr>{}</tr>'.format(
+        ''.join('<th>{}</th>'.format(x) for x in header))]
+    for row in rows:
+        table.append('<tr>{}</tr>'.format(''.join('<td>{}</td>'.format(html.escape(str(x))) for x in row)))
+    table.append('</table>')
+    start_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(min(x['time'] for x in events)))
+    body = [
+        '<html><head><meta charset="utf-8"><title>nestpipe timeline</title></head>',
+        '<body style="font-family:sans-serif">',
+        '<h2>Run started at {}</h2>'.format(start_time),
+        '<p>Wall time: {}s, attempts: {}, task time: {}s, mean concurrency: {}, '
+        'time with ready tasks but nothing running: {}s</p>'.format(
+            round(span, 3), len(attempts), round(busy, 3), round(busy / max(span, 1e-6), 2), round(idle, 3)),
+        '<h3>Concurrency over time</h3>',
+        _concurrency_svg([('running', '#4E79A7', running_series), ('ready', '#E15759', ready_series)], span),
+        '<h3>Steps</h3>', '\n'.join(table),
+        '<h3>Gantt chart by worker slot</h3>', _gantt_svg(slot_rows, slot_bars, colors, span),
+        '<h3>Gantt chart by main step</h3>', _gantt_svg(step_rows, step_bars, colors, span),
+        '</body></html>',
+    ]
+    with open(out_file, 'w') as f:
+        f.write('\n'.join(body))
+    return out_file
+
+
+def report(outdir, out_file=None, run=-1):
+    events = load_events(os.path.join(outdir, 'events.jsonl'), run=run)
+    if not events:
+        raise Exception('We found no events in {}!'.format(outdir))
+    return write_report(events, out_file or os.path.join(outdir, 'timeline.html'))
@@ -0,0 +1,156 @@
+# coding=utf-8
+__author__ = 'gudeqing'
+import os
+import sys
+import hmac
+import threading
+import socketserver
+from nestpipe.nestpipe import Command, LocalExecutor, send_message, recv_message, set_logger
+from nestpipe.launcher import kill_process_group
+from nestpipe.cpu_affinity import CoreMap
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    """
+    每个连接对应一个任务: 连接建立后调度端先发送auth消息, 口令正确时报告本节点的cpu和内存, 然后接收run消息并执行任务,
+    执行期间回传进程号和资源采样, 收到kill消息或连接断开时杀掉任务, 最后回传退出码
+    """
+    def handle(self):
+        agent = self.server.agent
+        lock = threading.Lock()
+        try:
+            message = recv_message(self.rfile)
+        except (OSError, ValueError):
+            return
+        if not isinstance(message, dict) or message.get('type') != 'auth' or not agent.check_token(message.get('token')):
+            agent.logger.warning('Reject connection from {}: invalid token'.format(self.client_address[0]))
+            send_message(self.wfile, dict(type='error', message='invalid token'))
+            return
+        send_message(self.wfile, agent.hello())
+        try:
+            message = recv_message(self.rfile)
+        except (OSError, ValueError):
+            return
+        if message is None or message.get('type') != 'run':
+            return
+        cmd = Command(
+            message['cmd'], message['name'], timeout=message['timeout'], outdir=message['outdir'],
+            monitor_resource=message['monitor_resource'], monitor_time_step=message['monitor_time_step'],
+            log_max_size=message['log_max_size'], logger=agent.logger,
+            cpu=message.get('cpu', 0), executor=agent.executor,
+        )
+        thread = threading.Thread(target=cmd.run, daemon=True)
+        thread.start()
+        while not cmd.started.wait(0.1):
+            if not thread.is_alive():
+                break
+        with lock:
+            send_message(self.wfile, dict(type='started', pid=cmd.proc.pid if cmd.proc else None))
+        listener = threading.Thread(target=self._listen, args=(cmd,), daemon=True)
+        listener.start()
+        try:
+            while True:
+                thread.join(cmd.monitor_time_step)
+                if not thread.is_alive():
+                    break
+                with lock:
+                    send_message(self.wfile, dict(
+                        type='sample', max_cpu=cmd.max_cpu, max_mem=cmd.max_mem, cur_cpu=cmd.cur_cpu,
+                        cur_mem=cmd.cur_mem, read_bytes=cmd.read_bytes,
+                        write_bytes=cmd.write_bytes, max_io_rate=cmd.max_io_rate,
+                    ))
+            with lock:
+                send_message(self.wfile, dict(
+                    type='exit', returncode=cmd.proc.returncode if cmd.proc else -1,
+                    max_cpu=cmd.max_cpu, max_mem=cmd.max_mem, stdout=cmd.stdout, stderr=cmd.stderr,
+                    read_bytes=cmd.read_bytes, write_bytes=cmd.write_bytes, max_io_rate=cmd.max_io_rate,
+                    timed_out=cmd.timed_out, exit_class=cmd.exit_class,
+                ))
+        except OSError:
+            # 调度端已断开
+            self._kill(cmd)
+
+    def _listen(self, cmd):
+        # 收到kill消息或连接断开时杀掉任务
+        while True:
+            try:
+                message = recv_message(self.rfile)
+            except (OSError, ValueError):
+                message = None
+            if message is None or message.get('type') == 'kill':
+                self._kill(cmd)
+                return
+
+    @staticmethod
+    def _kill(cmd):
+        if cmd.proc is not None:
+            kill_process_group(cmd.proc)
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class WorkerAgent(object):
+    def __init__(self, host='127.0.0.1', port=7000, cpu=None, mem=None, log_file='worker.log', pin_cpu=False,
+                 io_budget=None, token=None):
+        """
+        :param token: 调度端需要提供的口令, 与pipeline.ini中[mode]的worker_token相同
+        """
+        if not token:
+            raise Exception('A token is required to start a worker, see -token or NESTPIPE_WORKER_TOKEN')
+        self.token = token
+        self.host = host
+        self.port = int(port)
+        self.cpu = cpu
+        self.mem = mem
+        self.io_budget = io_budget
+        self.logger = set_logger(log_file, logger_id='worker')
+        # 所有任务共用一个执行器, 绑定cpu时才能分配互不重叠的cpu
+        self.executor = LocalExecutor(core_map=CoreMap() if pin_cpu else None, thread_env=pin_cpu)
+        self.server = None
+
+    def check_token(self, token):
+        return isinstance(token, str) and hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8'))
+
+    def hello(self):
+        hello = LocalExecutor().hello()
+        if self.cpu:
+            hello['cpu'] = self.cpu
+        if self.mem:
+            hello['mem'] = self.mem
+        if self.io_budget:
+            hello['io'] = self.io_budget
+        return hello
+
+    def serve_forever(self):
+        self.server = WorkerServer((self.host, self.port), WorkerHandler)
+        self.server.agent = self
+        self.logger.warning('Worker is listening on {}:{}'.format(self.host, self.server.server_address[1]))
+        self.server.serve_forever()
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def run_worker(args):
+    # 口令也可以放在环境变量中, 避免出现在进程列表里
+    token = args.token or os.environ.get('NESTPIPE_WORKER_TOKEN')
+    if not token:
+        exit('A token is required, use -token or set NESTPIPE_WORKER_TOKEN, '
+             'and set the same worker_token in [mode] of pipeline.ini')
+    WorkerAgent(args.host, args.port, cpu=args.cpu, mem=args.mem, log_file=args.log,
+                pin_cpu=args.pin_cpu, io_budget=args.io_budget, token=token).serve_forever()
+
+
+def main():
+    sys.argv.insert(1, 'worker')
+    from nestpipe.__main__ import main as nestpipe_main
+    nestpipe_main()
+
+
+if __name__ == '__main__':
+    main()
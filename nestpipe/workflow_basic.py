@@ -5,6 +5,7 @@ from pprint import pprint
 import configparser
 import shutil
 from nestpipe.nestpipe import RunCommands, set_logger
+from nestpipe.resource_tuning import ResourceTuner
 import time
 
 
@@ -313,6 +314,14 @@ class Basic(object):
         for step, path in self.new_dirs.items():
             self.mkdir(path, delay=False)
 
+        # 根据以往项目实测的资源消耗给出或直接使用资源申报
+        if arguments.tune_from:
+            tuner = ResourceTuner(arguments.tune_from, quantile=arguments.tune_quantile,
+                                  headroom=arguments.tune_headroom)
+            tuned = tuner.tune(commands, apply=arguments.tune_mode == 'apply')
+            self.logger.warning('{} of {} steps got resource {} from past runs'.format(
+                len(tuned), len(commands.sections()) - 1, 'tuned' if arguments.tune_mode == 'apply' else 'suggestions'))
+
         # ---------write pipeline cmds--------------------
         with open(os.path.join(project_dir, 'pipeline.ini'), 'w') as configfile:
             commands.write(configfile)
@@ -364,11 +373,19 @@ def basic_arg_parser():
     parser.add_argument('--monitor_time_step', default=3, type=int,
                         help='监控资源时的时间间隔, 默认3秒, 如需对某一步设置不同的值, 可在运行流程前修改pipeline.ini')
     parser.add_argument('-wait_resource_time', default=1500, type=int,
-                        help="等待资源的时间上限, 默认1500秒, 等待时间超过这个时间时,资源不足时判定任务失败")
+                        help="等待资源的时间, 默认1500秒, 任务因资源不足排队超过这个时间时给出警告, 任务继续排队")
     parser.add_argument('--no_check_resource_before_run', default=False, action='store_true',
-                        help="指示运行某步骤前检测指定的资源是否足够, 如不足, 则该步骤失败; 如果设置该参数, 则运行前不检查资源. "
+                        help="指示运行某步骤前按指定的资源进行预留, 如不足, 则该步骤排队等待; 如果设置该参数, 则运行前不检查资源. "
                              "如需对某一步设置不同的值,可运行前修改pipeline.ini. "
                              "如需更改指定的资源, 可在运行流程前修改pipeline.ini")
+    parser.add_argument('-tune_from', default=list(), nargs='+',
+                        help="以往的结果目录, 空格分隔. 按步骤名和工具汇总这些项目中实测的峰值cpu/内存/耗时, "
+                             "估计本次流程每一步的资源申报")
+    parser.add_argument('-tune_mode', default='suggest', choices=['suggest', 'apply'],
+                        help="suggest: 建议值写入pipeline.ini的suggest_cpu/suggest_mem/suggest_time, 不影响运行; "
+                             "apply: 直接改写cpu和mem, 原值保存为orig_cpu/orig_mem. 默认suggest")
+    parser.add_argument('-tune_quantile', default=0.95, type=float, help="估计资源申报时取实测值的分位数, 默认0.95")
+    parser.add_argument('-tune_headroom', default=1.2, type=float, help="在分位数之上预留的余量倍数, 默认1.2")
     parser.add_argument('--plot', action='store_true', default=False,
                         help="if set, running state will be visualized if pygraphviz installed")
     return parser
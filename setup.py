@@ -23,4 +23,10 @@ setup(
         "argparse>=1.1.0",
     ],
     setup_requires=[],
+    entry_points={
+        'console_scripts': [
+            'nestpipe=nestpipe.__main__:main',
+            'nestpipe-worker=nestpipe.worker:main',
+        ],
+    },
 )
@@ -0,0 +1,389 @@
+# coding=utf-8
+"""
+本机冒烟测试: 在localhost上启动worker运行示例流程, 两个调度进程以共享模式运行同一个流程, 以及HTTP状态接口.
+运行: python -m pytest -q tests
+"""
+import os
+import sys
+import glob
+import json
+import time
+import atexit
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+import configparser
+import unittest
+import urllib.request
+import urllib.error
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from nestpipe.nestpipe import RunCommands, Command, RemoteExecutor, read_state_table  # noqa: E402
+
+SAMPLE = os.path.join(ROOT, 'test_simple_pipeline', 'pipeline_sample.ini')
+TOKEN = 'smoke-test-token'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception('worker on port {} did not start'.format(port))
+
+
+def subprocess_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+
+def write_config(path, mode, tasks=None, base=SAMPLE):
+    """以base为模板, 用mode覆盖[mode]中的设置, tasks不为空时替换全部任务"""
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str
+    config.read(base, encoding='utf-8')
+    for key, value in mode.items():
+        config['mode'][key] = str(value)
+    if tasks is not None:
+        for name in config.sections():
+            if name != 'mode':
+                config.remove_section(name)
+        for name, options in tasks.items():
+            config[name] = options
+    with open(path, 'w') as f:
+        config.write(f)
+    return path
+
+
+def run_pipeline(config, outdir):
+    workflow = RunCommands(config, outdir=outdir)
+    result = workflow.parallel_run()
+    # 流程已正常结束, 测试目录删除后不需要在退出时再写状态表
+    atexit.unregister(workflow._update_status_when_exit)
+    return result
+
+
+def read_events(outdir):
+    with open(os.path.join(outdir, 'events.jsonl')) as f:
+        return [json.loads(x) for x in f]
+
+
+class SmokeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='nestpipe.test.')
+        self.outdir = os.path.join(self.tmp, 'out')
+        os.makedirs(self.outdir)
+        self.procs = list()
+
+    def tearDown(self):
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def start_worker(self, cpu=2):
+        port = free_port()
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'nestpipe', 'worker', '-host', '127.0.0.1', '-port', str(port),
+             '-cpu', str(cpu), '-token', TOKEN, '-log', os.path.join(self.tmp, 'worker.{}.log'.format(port))],
+            env=subprocess_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        self.procs.append(proc)
+        wait_port(port)
+        return '127.0.0.1:{}'.format(port)
+
+
+class WorkerTest(SmokeTest):
+    def test_sample_pipeline_on_two_workers(self):
+        # 示例流程全部交给两个本机worker运行
+        workers = [self.start_worker(), self.start_worker()]
+        config = write_config(os.path.join(self.tmp, 'pipeline.ini'), dict(
+            workers=','.join(workers), worker_token=TOKEN, run_local=False, monitor_time_step=1, resource_series=False,
+        ))
+        for engine in ['thread', 'asyncio']:
+            with self.subTest(engine=engine):
+                outdir = os.path.join(self.outdir, engine)
+                os.makedirs(outdir)
+                write_config(config, dict(engine=engine), base=config)
+                success, total = run_pipeline(config, outdir)
+                self.assertEqual(success, total)
+                nodes = {x['node'] for x in read_events(outdir) if x['event'] == 'attempt_end'}
+                self.assertTrue(nodes and nodes <= set(workers), nodes)
+                stdout = glob.glob(os.path.join(outdir, 'logs', 'G.*stdout.txt'))
+                self.assertTrue(stdout)
+                with open(stdout[0]) as f:
+                    self.assertIn('I am worker G', f.read())
+
+    def test_remote_failure_is_retried(self):
+        worker = self.start_worker()
+        config = write_config(os.path.join(self.tmp, 'pipeline.ini'), dict(
+            workers=worker, worker_token=TOKEN, run_local=False, retry=1, monitor_time_step=1, resource_series=False,
+        ), tasks=dict(
+            ok_1=dict(cmd='echo ok'),
+            bad_1=dict(cmd='exit 3'),
+            after_1=dict(cmd='echo after', depend='bad_1'),
+        ))
+        success, total = run_pipeline(config, self.outdir)
+        self.assertEqual((success, total), (1, 3))
+        attempts = [x for x in read_events(self.outdir) if x['event'] == 'attempt_end' and x['name'] == 'bad_1']
+        self.assertEqual([x['returncode'] for x in attempts], [3, 3])
+        self.assertEqual(read_state_table(self.outdir)['after_1']['used_time'], 'FailedDependencies')
+
+    def test_worker_rejects_wrong_token(self):
+        # 口令不对时worker不报告资源也不运行命令, 调度端不注册该worker, 任务在本机运行
+        worker = self.start_worker()
+        marker = os.path.join(self.tmp, 'marker.txt')
+        with self.assertRaises(OSError):
+            RemoteExecutor(*worker.split(':'), token='wrong').hello()
+        cmd = Command('touch {}'.format(marker), 'x_1', outdir=self.tmp, executor=RemoteExecutor(*worker.split(':')))
+        cmd.run()
+        self.assertEqual(cmd.proc.returncode, -1)
+        self.assertFalse(os.path.exists(marker))
+        config = write_config(os.path.join(self.tmp, 'pipeline.ini'), dict(
+            workers=worker, worker_token='wrong', monitor_time_step=1, resource_series=False,
+        ), tasks=dict(ok_1=dict(cmd='echo ok')))
+        self.assertEqual(run_pipeline(config, self.outdir), (1, 1))
+        nodes = {x['node'] for x in read_events(self.outdir) if x['event'] == 'attempt_end'}
+        self.assertEqual(nodes, {'local'})
+
+
+class SharedModeTest(SmokeTest):
+    def test_two_schedulers_share_one_outdir(self):
+        # 两个调度进程同时运行同一个流程, 每个任务只能被运行一次
+        marker = os.path.join(self.tmp, 'ran.txt')
+        tasks = dict()
+        for index in range(12):
+            tasks['s_{}'.format(index)] = dict(cmd='echo s_{} >> {}; sleep 0.2'.format(index, marker))
+        tasks['t_1'] = dict(cmd='echo t_1 >> {}'.format(marker), depend=','.join(tasks))
+        config = write_config(os.path.join(self.tmp, 'pipeline.ini'), dict(
+            shared=True, shared_poll_interval=0.2, threads=2, retry=0, monitor_time_step=1,
+            check_resource_before_run=False, resource_series=False,
+        ), tasks=tasks)
+        code = 'from nestpipe.nestpipe import RunCommands; RunCommands({!r}, outdir={!r}).parallel_run()'.format(
+            config, self.outdir)
+        for _ in range(2):
+            self.procs.append(subprocess.Popen(
+                [sys.executable, '-c', code], env=subprocess_env(),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            ))
+        for proc in self.procs:
+            self.assertEqual(proc.wait(timeout=120), 0)
+        with open(marker) as f:
+            ran = f.read().split()
+        self.assertEqual(sorted(ran), sorted(tasks))
+        state = read_state_table(self.outdir)
+        self.assertTrue(all(state[x]['state'] == 'success' for x in tasks))
+
+
+    def test_fresh_lease_is_not_broken(self):
+        # 重命名时拿到的是其他节点刚创建的新租约, 需要还回去并认领失败
+        from nestpipe.shared import SharedWorkspace
+        first = SharedWorkspace(self.outdir, node='a', lease_timeout=60)
+        second = SharedWorkspace(self.outdir, node='b', lease_timeout=60)
+        self.assertTrue(first.claim('x_1'))
+        self.assertFalse(second._break_lease('x_1'))
+        self.assertEqual(second.owner('x_1'), 'a')
+        self.assertFalse(second.claim('x_1'))
+        old = time.time() - 120
+        os.utime(first._lease_file('x_1'), (old, old))
+        self.assertTrue(second.claim('x_1'))
+        self.assertEqual(second.owner('x_1'), 'b')
+        first.stop()
+        second.stop()
+
+    def test_success_in_any_journal_wins(self):
+        # 节点日志按文件名回放, 后面的日志中残留的running记录不能覆盖其他节点记录的成功
+        journal_dir = os.path.join(self.outdir, 'shared', 'journals')
+        os.makedirs(journal_dir)
+        with open(os.path.join(journal_dir, 'a.journal'), 'w') as f:
+            f.write('x_1\tsuccess\t1\t0\t0\t12\n')
+        with open(os.path.join(journal_dir, 'b.journal'), 'w') as f:
+            f.write('x_1\trunning\tunknown\t0\t0\t34\n')
+        self.assertEqual(read_state_table(self.outdir)['x_1']['state'], 'success')
+
+
+class ScriptModeTest(SmokeTest):
+    def test_run_nestpipe_py_as_script(self):
+        # 文档中的 'python nestpipe/nestpipe.py -cfg ...' 用法, 模块以平铺方式导入
+        config = write_config(os.path.join(self.tmp, 'pipeline.ini'), dict(
+            threads=2, monitor_time_step=1, check_resource_before_run=False, resource_series=False,
+        ), tasks=dict(a_1=dict(cmd='echo a'), b_1=dict(cmd='echo b', depend='a_1')))
+        proc = subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'nestpipe', 'nestpipe.py'), '-cfg', config, '-outdir', self.outdir],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=120,
+        )
+        self.assertEqual(proc.returncode, 0, proc.stdout.decode('utf-8', 'replace'))
+        state = read_state_table(self.outdir)
+        self.assertEqual({x['state'] for x in state.values()}, {'success'})
+        events = read_events(self.outdir)
+        self.assertEqual([events[0]['event'], events[-1]['event']], ['run_start', 'run_end'])
+
+
+class BatchTest(SmokeTest):
+    def test_batch_with_one_thread_ends(self):
+        # 合并到批次中的任务不再留在就绪队列中, 否则队列永远不空, 流程无法结束
+        tasks = {'s_{}'.format(x): dict(cmd='echo s_{}'.format(x), batch='3') for x in range(3)}
+        for engine in ['thread', 'asyncio']:
+            with self.subTest(engine=engine):
+                outdir = os.path.join(self.outdir, engine)
+                os.makedirs(outdir)
+                config = write_config(os.path.join(self.tmp, engine + '.ini'), dict(
+                    engine=engine, threads=1, monitor_time_step=1, check_resource_before_run=False,
+                    resource_series=False,
+                ), tasks=tasks)
+                workflow = RunCommands(config, outdir=outdir)
+                thread = threading.Thread(target=workflow.parallel_run, daemon=True)
+                thread.start()
+                thread.join(timeout=60)
+                atexit.unregister(workflow._update_status_when_exit)
+                self.assertFalse(thread.is_alive())
+                self.assertEqual(workflow.success, 3)
+                self.assertEqual(workflow._status_snapshot()['queue_depth'], 0)
+
+
+class PressureTest(SmokeTest):
+    def test_retried_task_is_not_resumed(self):
+        # 挂起的任务失败后重新排队, 不再留在挂起列表中; 残留的记录在恢复时被跳过, 不会让监控线程退出
+        config = write_config(os.path.join(self.tmp, 'pipeline.ini'), dict(
+            retry=1, monitor_time_step=1, check_resource_before_run=False, resource_series=False,
+        ), tasks=dict(bad_1=dict(cmd='exit 3')))
+        workflow = RunCommands(config, outdir=self.outdir)
+        atexit.unregister(workflow._update_status_when_exit)
+        with workflow.cond:
+            name = workflow._pick_task()
+            workflow.running.add(name)
+        cmd, tmp_dict = workflow._new_command(name)
+        cmd.run()
+        with workflow.cond:
+            workflow.suspended.append(name)
+            self.assertTrue(workflow._retry_later(cmd, tmp_dict, 1, None))
+            self.assertEqual(workflow.suspended, [])
+            workflow.suspended.append(name)
+            workflow._resume_task(0)
+            self.assertEqual(workflow.suspended, [])
+
+
+class PinCpuTest(SmokeTest):
+    def test_pinned_tasks_leave_scheduler_affinity(self):
+        # 启动任务时只临时改变启动线程的cpu绑定, 结束后调度进程的绑定不变
+        default_cores = os.sched_getaffinity(0)
+        tasks = {'p_{}'.format(x): dict(cmd='grep Cpus_allowed_list /proc/self/status', cpu='1') for x in range(4)}
+        for engine in ['thread', 'asyncio']:
+            for log_max_size in [0, 100000]:
+                with self.subTest(engine=engine, log_max_size=log_max_size):
+                    outdir = os.path.join(self.outdir, '{}.{}'.format(engine, log_max_size))
+                    os.makedirs(outdir)
+                    config = write_config(os.path.join(self.tmp, engine + '.ini'), dict(
+                        engine=engine, pin_cpu=True, threads=2, log_max_size=log_max_size, monitor_time_step=1,
+                        check_resource_before_run=False, resource_series=False,
+                    ), tasks=tasks)
+                    self.assertEqual(run_pipeline(config, outdir), (4, 4))
+                    self.assertEqual(os.sched_getaffinity(0), default_cores)
+                    for stdout in glob.glob(os.path.join(outdir, 'logs', 'p_*stdout.txt')):
+                        with open(stdout) as f:
+                            self.assertIn('Cpus_allowed_list', f.read())
+
+
+class AsyncioEngineTest(SmokeTest):
+    def test_thread_count_stays_flat(self):
+        # 同时运行的本机任务不再各自占用一个等待子进程退出的线程
+        tasks = {'s_{}'.format(x): dict(cmd='sleep 1') for x in range(40)}
+        config = write_config(os.path.join(self.tmp, 'pipeline.ini'), dict(
+            engine='asyncio', threads=40, monitor_time_step=1, check_resource_before_run=False, resource_series=False,
+        ), tasks=tasks)
+        baseline, peak, stopped = threading.active_count(), [0], threading.Event()
+
+        def watch():
+            while not stopped.is_set():
+                peak[0] = max(peak[0], threading.active_count())
+                time.sleep(0.05)
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        try:
+            self.assertEqual(run_pipeline(config, self.outdir), (40, 40))
+        finally:
+            stopped.set()
+            watcher.join()
+        self.assertLess(peak[0] - baseline, 20, peak[0])
+
+
+class ReportTest(SmokeTest):
+    def test_lanes_and_idle_time(self):
+        from nestpipe.timeline import assign_lanes, idle_time, report
+        self.assertEqual(assign_lanes([(0, 5), (1, 2), (2, 4), (3, 6), (5, 7)]), [0, 1, 1, 2, 0])
+        # 运行区间只覆盖就绪区间的一部分时, 其余部分仍是空闲: 0-1, 2-3和4-5
+        self.assertAlmostEqual(idle_time([(0, 3), (4, 5)], [(1, 2)]), 3)
+        config = write_config(os.path.join(self.tmp, 'pipeline.ini'), dict(
+            threads=2, monitor_time_step=1, check_resource_before_run=False, resource_series=False,
+        ), tasks=dict(a_1=dict(cmd='sleep 0.2'), a_2=dict(cmd='sleep 0.2'), b_1=dict(cmd='echo b', depend='a_1')))
+        run_pipeline(config, self.outdir)
+        with open(report(self.outdir)) as f:
+            self.assertIn('time with ready tasks but nothing running', f.read())
+
+
+class StatusServerTest(SmokeTest):
+    def get(self, url):
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.read().decode('utf-8')
+
+    def test_status_endpoints(self):
+        config = write_config(os.path.join(self.tmp, 'pipeline.ini'), dict(
+            status_port=0, threads=2, monitor_time_step=1, check_resource_before_run=False, resource_series=False,
+        ), tasks=dict(
+            a_1=dict(cmd='sleep 2'),
+            a_2=dict(cmd='sleep 2'),
+            b_1=dict(cmd='echo b', depend='a_1,a_2'),
+        ))
+        workflow = RunCommands(config, outdir=self.outdir)
+        thread = threading.Thread(target=workflow.parallel_run)
+        thread.start()
+        url_file = os.path.join(self.outdir, 'status_url.txt')
+        deadline = time.time() + 20
+        while not os.path.exists(url_file) and time.time() < deadline:
+            time.sleep(0.05)
+        with open(url_file) as f:
+            url = f.read().strip()
+        time.sleep(0.5)
+        status = json.loads(self.get(url + '/status'))
+        self.assertEqual(status['total'], 3)
+        self.assertEqual(status['states'].get('running'), 2)
+        metrics = self.get(url + '/metrics')
+        self.assertIn('nestpipe_tasks{state="running"} 2', metrics)
+        self.assertIn('nestpipe_dispatch_latency_seconds_count 2', metrics)
+        events = json.loads(self.get(url + '/events.json?since=0'))
+        self.assertEqual(sorted(x['name'] for x in events if x['event'] == 'started'), ['a_1', 'a_2'])
+        since = events[-1]['id']
+        self.assertEqual(json.loads(self.get(url + '/events.json?since={}'.format(since))), [])
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            self.get(url + '/nothing')
+        self.assertEqual(error.exception.code, 404)
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            self.get(url + '/events.json?since=abc')
+        self.assertEqual(error.exception.code, 400)
+        request = urllib.request.Request(url + '/events', headers={'Last-Event-ID': 'abc'})
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request, timeout=10)
+        self.assertEqual(error.exception.code, 400)
+        thread.join(timeout=60)
+        atexit.unregister(workflow._update_status_when_exit)
+        self.assertEqual(workflow.success, 3)
+        with self.assertRaises(OSError):
+            self.get(url + '/status')
+
+
+if __name__ == '__main__':
+    unittest.main()